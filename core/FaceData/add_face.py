@@ -3,8 +3,14 @@ import sys
 import json
 
 from .base import Base, ENGINE
-from .models import FData, FEmbed, FLoc
-from .utils import SessionCM, commit_add_db_row
+from .models import FData, FEmbedBlob, FBox, ScrapeState
+from .utils import (
+    SessionCM,
+    commit_add_db_row,
+    embedding_to_blob,
+    loc_to_box,
+)
+from ..utils import bulk_insert_ignore, parse_img_id
 
 Base.metadata.create_all(ENGINE)
 
@@ -15,13 +21,59 @@ def add_data(
     fdata_row = FData(vec_id=vec_id, post_url=post_url, img_url=img_url)
     commit_add_db_row(session, fdata_row)
 
-    for embed_idx, embed_val in enumerate(face_embedding):
-        fembed_row = FEmbed(vec_id=vec_id, embed_idx=embed_idx, embed_val=embed_val)
-        commit_add_db_row(session, fembed_row)
+    fembed_row = FEmbedBlob(vec_id=vec_id, embedding=embedding_to_blob(face_embedding))
+    commit_add_db_row(session, fembed_row)
 
-    for loc_idx, loc_val in enumerate(face_loc):
-        floc_row = FLoc(vec_id=vec_id, loc_idx=loc_idx, loc_val=loc_val)
-        commit_add_db_row(session, floc_row)
+    fbox_row = FBox(**loc_to_box(vec_id, face_loc))
+    commit_add_db_row(session, fbox_row)
+
+
+def add_many_data(session, faces, chunk_size=5000):
+    """adds the data of many faces in a single transaction (with bulk inserts)
+
+    Args:
+        faces: list of dicts with the arguments of add_data
+            (vec_id, face_embedding, face_loc, post_url, img_url)
+    Faces that already exist are skipped
+    """
+    fdata_rows, fembed_rows, fbox_rows = [], [], []
+    for face in faces:
+        vec_id = face["vec_id"]
+
+        fdata_rows.append(
+            {"vec_id": vec_id, "post_url": face["post_url"], "img_url": face["img_url"]}
+        )
+        fembed_rows.append(
+            {"vec_id": vec_id, "embedding": embedding_to_blob(face["face_embedding"])}
+        )
+        fbox_rows.append(loc_to_box(vec_id, face["face_loc"]))
+
+    bulk_insert_ignore(session, FData.__table__, fdata_rows, chunk_size)
+    bulk_insert_ignore(session, FEmbedBlob.__table__, fembed_rows, chunk_size)
+    bulk_insert_ignore(session, FBox.__table__, fbox_rows, chunk_size)
+    session.commit()
+
+
+def update_scrape_state(session, img_id, num_faces):
+    """records that the image img_id ("<timestamp>_<domain>_<account_name>_<img_num>")
+    was scraped and had num_faces faces
+
+    Doesn't commit; the state must be committed together with the face data of
+    the image (Eg: by add_many_data)
+    """
+    timestamp, domain, account, img_num = parse_img_id(img_id)
+
+    state = session.query(ScrapeState).get((domain, account))
+    if state is None:
+        state = ScrapeState(domain, account, img_num, timestamp, 0, 0)
+        session.add(state)
+
+    if img_num >= state.last_post_num:
+        state.last_post_num = img_num
+        state.last_timestamp = timestamp
+
+    state.num_images += 1
+    state.num_faces += num_faces
 
 
 def add_json_data(session, filepath):
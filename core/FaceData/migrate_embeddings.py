@@ -0,0 +1,98 @@
+"""
+Converts the embeddings stored as 128 fembed rows per face into
+a single float32 blob per face (fvec table)
+
+usage: python -m core.FaceData.migrate_embeddings [--batch-size 1000] [--drop-fembed]
+"""
+import argparse
+from collections import defaultdict
+
+from sqlalchemy import distinct
+
+from .base import Base, ENGINE
+from .models import FEmbed, FEmbedBlob
+from .utils import SessionCM, embedding_to_blob
+from ..LSH.config import EMBEDDING_SIZE
+from ..utils import bulk_insert_ignore
+
+Base.metadata.create_all(ENGINE)
+
+
+def migrate_embeddings(session, batch_size=1000, drop_fembed=False):
+    """Copies every fembed embedding into the fvec table, batch_size faces per transaction.
+    Faces that are already present in fvec are left untouched, so the migration
+    can be interrupted and resumed at any time
+
+    Returns: number of faces that were processed
+    """
+    num_faces = 0
+    last_vec_id = ""
+
+    while True:
+        vec_ids = (
+            session.query(distinct(FEmbed.vec_id))
+            .filter(FEmbed.vec_id > last_vec_id)
+            .order_by(FEmbed.vec_id)
+            .limit(batch_size)
+            .all()
+        )
+        vec_ids = [x[0] for x in vec_ids]
+        if not vec_ids:
+            break
+
+        results = (
+            session.query(FEmbed.vec_id, FEmbed.embed_val)
+            .filter(FEmbed.vec_id.in_(vec_ids))
+            .order_by(FEmbed.vec_id, FEmbed.embed_idx)
+            .all()
+        )
+
+        embeddings = defaultdict(list)
+        for vec_id, embed_val in results:
+            embeddings[vec_id].append(embed_val)
+
+        rows = [
+            {"vec_id": vec_id, "embedding": embedding_to_blob(embedding)}
+            for vec_id, embedding in embeddings.items()
+            if len(embedding) == EMBEDDING_SIZE
+        ]
+        num_skipped = len(embeddings) - len(rows)
+        if num_skipped:
+            print("* skipped {} incomplete embeddings".format(num_skipped))
+        bulk_insert_ignore(session, FEmbedBlob.__table__, rows)
+
+        if drop_fembed:
+            # only the rows that were copied (the incomplete ones are kept)
+            migrated = [row["vec_id"] for row in rows]
+            session.query(FEmbed).filter(FEmbed.vec_id.in_(migrated)).delete(
+                synchronize_session=False
+            )
+
+        session.commit()
+        last_vec_id = vec_ids[-1]
+
+        num_faces += len(vec_ids)
+        print("migrated {} faces".format(num_faces))
+
+    return num_faces
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of faces converted per transaction",
+    )
+    ap.add_argument(
+        "--drop-fembed",
+        action="store_true",
+        help="delete the fembed rows once they are converted (run VACUUM afterwards to reclaim the space)",
+    )
+    args = ap.parse_args()
+
+    with SessionCM() as session:
+        migrate_embeddings(
+            session, batch_size=args.batch_size, drop_fembed=args.drop_fembed
+        )
@@ -0,0 +1,90 @@
+"""
+Converts the face locations stored as 4 floc rows per face into
+a single row per face (fbox table)
+
+usage: python -m core.FaceData.migrate_locations [--batch-size 1000] [--drop-floc]
+"""
+import argparse
+from collections import defaultdict
+
+from sqlalchemy import distinct
+
+from .base import Base, ENGINE
+from .models import FLoc, FBox
+from .utils import SessionCM, loc_to_box
+from ..utils import bulk_insert_ignore
+
+Base.metadata.create_all(ENGINE)
+
+
+def migrate_locations(session, batch_size=1000, drop_floc=False):
+    """Copies every floc location into the fbox table, batch_size faces per transaction.
+    Faces that are already present in fbox are left untouched, so the migration
+    can be interrupted and resumed at any time
+
+    Returns: number of faces that were processed
+    """
+    num_faces = 0
+    last_vec_id = ""
+
+    while True:
+        vec_ids = (
+            session.query(distinct(FLoc.vec_id))
+            .filter(FLoc.vec_id > last_vec_id)
+            .order_by(FLoc.vec_id)
+            .limit(batch_size)
+            .all()
+        )
+        vec_ids = [x[0] for x in vec_ids]
+        if not vec_ids:
+            break
+
+        results = (
+            session.query(FLoc.vec_id, FLoc.loc_val)
+            .filter(FLoc.vec_id.in_(vec_ids))
+            .order_by(FLoc.vec_id, FLoc.loc_idx)
+            .all()
+        )
+
+        locs = defaultdict(list)
+        for vec_id, loc_val in results:
+            locs[vec_id].append(loc_val)
+
+        rows = [loc_to_box(vec_id, loc) for vec_id, loc in locs.items() if len(loc) == 4]
+        if len(rows) < len(locs):
+            print("* skipped {} incomplete locations".format(len(locs) - len(rows)))
+        bulk_insert_ignore(session, FBox.__table__, rows)
+
+        if drop_floc:
+            # only the rows that were copied (the incomplete ones are kept)
+            migrated = [row["vec_id"] for row in rows]
+            session.query(FLoc).filter(FLoc.vec_id.in_(migrated)).delete(
+                synchronize_session=False
+            )
+
+        session.commit()
+        last_vec_id = vec_ids[-1]
+
+        num_faces += len(vec_ids)
+        print("migrated {} faces".format(num_faces))
+
+    return num_faces
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of faces converted per transaction",
+    )
+    ap.add_argument(
+        "--drop-floc",
+        action="store_true",
+        help="delete the floc rows once they are converted (run VACUUM afterwards to reclaim the space)",
+    )
+    args = ap.parse_args()
+
+    with SessionCM() as session:
+        migrate_locations(session, batch_size=args.batch_size, drop_floc=args.drop_floc)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Text, Integer, Float, ForeignKey
+from sqlalchemy import Column, Text, Integer, Float, LargeBinary, ForeignKey
 from sqlalchemy.schema import PrimaryKeyConstraint
 
 from .base import Base
@@ -45,6 +45,24 @@ class FEmbed(Base, AutoRepr):
         self.embed_val = embed_val
 
 
+class FEmbedBlob(Base, AutoRepr):
+    """the whole face embedding stored as a single little-endian float32 blob"""
+
+    __tablename__ = "fvec"
+
+    vec_id = Column(Text, ForeignKey("fdata.vec_id"))
+    embedding = Column(LargeBinary)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(vec_id),
+        {},
+    )
+
+    def __init__(self, vec_id, embedding):
+        self.vec_id = vec_id
+        self.embedding = embedding
+
+
 class FLoc(Base, AutoRepr):
     __tablename__ = "floc"
 
@@ -61,3 +79,57 @@ class FLoc(Base, AutoRepr):
         self.vec_id = vec_id
         self.loc_idx = loc_idx
         self.loc_val = loc_val
+
+
+class FBox(Base, AutoRepr):
+    """the whole face location stored as a single row (the four floc rows of a face);
+    Eg: the (left, top, right, bottom) box returned by core.utils.pil_compatible_bb
+    """
+
+    __tablename__ = "fbox"
+
+    vec_id = Column(Text, ForeignKey("fdata.vec_id"))
+    left = Column(Integer)
+    top = Column(Integer)
+    right = Column(Integer)
+    bottom = Column(Integer)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(vec_id),
+        {},
+    )
+
+    def __init__(self, vec_id, left, top, right, bottom):
+        self.vec_id = vec_id
+        self.left = left
+        self.top = top
+        self.right = right
+        self.bottom = bottom
+
+
+class ScrapeState(Base, AutoRepr):
+    """resume point of every scraped account (updated together with its face data)"""
+
+    __tablename__ = "scrape_state"
+
+    domain = Column(Text)
+    account = Column(Text)
+    last_post_num = Column(Integer)
+    last_timestamp = Column(Integer)
+    num_images = Column(Integer)
+    num_faces = Column(Integer)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(domain, account),
+        {},
+    )
+
+    def __init__(
+        self, domain, account, last_post_num, last_timestamp, num_images, num_faces
+    ):
+        self.domain = domain
+        self.account = account
+        self.last_post_num = last_post_num
+        self.last_timestamp = last_timestamp
+        self.num_images = num_images
+        self.num_faces = num_faces
@@ -0,0 +1,255 @@
+"""
+Append-only store of face embeddings backed by a memory-mapped float32 file
+
+    <store_dir>/embeddings.f32  -> raw (N x embedding_size) float32 matrix
+    <store_dir>/ids.txt         -> vec_id of every row of the matrix (one per line)
+
+The matrix is opened read-only with np.memmap, so every process that loads
+the same store shares the page-cache-backed vectors instead of copying them.
+Only one process should append to a store at a time (the store files are
+repaired when that process first appends to it).
+
+usage (build a store from the FaceData database):
+    python -m core.FaceData.store --store-dir ./embeddings
+"""
+import os
+import pathlib
+import argparse
+
+import numpy as np
+
+from .base import Base, ENGINE
+from .models import FEmbedBlob
+from .utils import SessionCM, blob_to_embedding
+
+Base.metadata.create_all(ENGINE)
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped embedding store that can also be used directly as a
+    batch mapper (ids -> matrix of embeddings) for SQLDiskLSH.query
+
+    Args:
+        store_dir: directory that holds the embeddings and ids files
+        embedding_size: the length of each embedding vector; Eg: 128
+        fallback: (optional) batch mapper used for the ids that are not in the store
+    """
+
+    is_batch_mapper = True
+
+    def __init__(self, store_dir="./embeddings", embedding_size=128, fallback=None):
+        self.store_dir = pathlib.Path(store_dir)
+        self.embeddings_file = self.store_dir / "embeddings.f32"
+        self.ids_file = self.store_dir / "ids.txt"
+        self.embedding_size = embedding_size
+        self.fallback = fallback
+
+        # the files are repaired once, before the first append of this process
+        self._repaired = False
+
+        self._reset()
+        self.refresh()
+
+    @property
+    def row_bytes(self):
+        return self.embedding_size * np.dtype("<f4").itemsize
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def _reset(self):
+        self._ids = []
+        self._rows = {}
+        # bytes of the ids file that hold the ids of the mapped rows
+        self._ids_offset = 0
+        self._ids_file_size = 0
+        self._matrix = np.empty((0, self.embedding_size), dtype="<f4")
+
+    def refresh(self):
+        """maps the rows appended since the last refresh (Eg: by other processes);
+        only the new part of the ids file is read
+        """
+        ids_file_size = 0
+        if self.ids_file.exists():
+            ids_file_size = os.path.getsize(self.ids_file)
+
+        if ids_file_size < self._ids_offset:
+            # the files were truncated by _repair; read them again
+            self._reset()
+
+        new_ids = []
+        if ids_file_size > self._ids_offset:
+            with self.ids_file.open("rb") as f:
+                f.seek(self._ids_offset)
+                # the last element is either empty or a partially written id
+                new_ids = f.read(ids_file_size - self._ids_offset).split(b"\n")[:-1]
+
+        num_rows = 0
+        if self.embeddings_file.exists():
+            num_rows = os.path.getsize(self.embeddings_file) // self.row_bytes
+        # rows that were only partially written are ignored
+        new_ids = new_ids[: max(num_rows - len(self._ids), 0)]
+
+        self._ids_file_size = ids_file_size
+        self._add_ids(new_ids)
+
+    def _add_ids(self, new_ids):
+        """maps the rows of the new ids (encoded) that follow the mapped rows"""
+        if not new_ids:
+            return
+
+        for id in new_ids:
+            self._ids_offset += len(id) + 1
+            id = id.decode("utf-8")
+            self._rows[id] = len(self._ids)
+            self._ids.append(id)
+
+        # mapping the file again only costs a mmap call
+        self._matrix = np.memmap(
+            self.embeddings_file,
+            dtype="<f4",
+            mode="r",
+            shape=(len(self._ids), self.embedding_size),
+        )
+
+    def append(self, ids, matrix):
+        """Appends the embeddings (rows of the matrix) of the given ids to the store.
+        ids that are already present in the store are skipped
+
+        the ids and rows of the store are updated in memory, so that a batched
+        ingest doesn't read the ids file again after every append
+        """
+        matrix = np.asarray(matrix, dtype="<f4").reshape(-1, self.embedding_size)
+
+        new_rows, new_ids, seen = [], [], set()
+        for row_num, id in enumerate(ids):
+            id = str(id)
+            if id not in self._rows and id not in seen:
+                new_rows.append(row_num)
+                new_ids.append(id)
+                seen.add(id)
+        if not new_rows:
+            return
+
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        if not self._repaired:
+            self._repair()
+            self._repaired = True
+
+        # embeddings are written before the ids, so that a crash in between
+        # leaves extra embedding rows behind (which are truncated by _repair)
+        with self.embeddings_file.open("ab") as f:
+            f.write(matrix[new_rows].tobytes())
+
+        encoded_ids = [id.encode("utf-8") for id in new_ids]
+        with self.ids_file.open("ab") as f:
+            f.write(b"".join(id + b"\n" for id in encoded_ids))
+
+        self._add_ids(encoded_ids)
+        self._ids_file_size = self._ids_offset
+
+    def get(self, ids):
+        """returns the embeddings of the given ids as a (len(ids) x embedding_size) matrix
+        (rows of unknown ids are filled with nan)
+        """
+        if self._is_stale() and any(id not in self._rows for id in ids):
+            self.refresh()
+
+        found = [row_num for row_num, id in enumerate(ids) if id in self._rows]
+        missing = [row_num for row_num, id in enumerate(ids) if id not in self._rows]
+
+        result = np.full((len(ids), self.embedding_size), np.nan)
+        if found:
+            result[found] = self._matrix[[self._rows[ids[i]] for i in found]]
+
+        if missing and self.fallback is not None:
+            result[missing] = self.fallback([ids[i] for i in missing])
+
+        return result
+
+    def __call__(self, ids):
+        return self.get(ids)
+
+    def _is_stale(self):
+        """True if another process appended to the store since the last refresh"""
+        if not self.ids_file.exists():
+            return False
+        return os.path.getsize(self.ids_file) != self._ids_file_size
+
+    def _repair(self):
+        """truncates the store files to the rows that were completely written"""
+        self.refresh()
+        num_rows = len(self._ids)
+
+        if self.embeddings_file.exists():
+            if os.path.getsize(self.embeddings_file) != num_rows * self.row_bytes:
+                with self.embeddings_file.open("r+b") as f:
+                    f.truncate(num_rows * self.row_bytes)
+
+        # the ids file must contain exactly one complete line per row
+        if self.ids_file.exists():
+            if os.path.getsize(self.ids_file) != self._ids_offset:
+                with self.ids_file.open("r+b") as f:
+                    f.truncate(self._ids_offset)
+                self._ids_file_size = self._ids_offset
+
+
+def iter_embedding_batches(session, batch_size=10000):
+    """yields (ids, matrix) batches of all the embeddings stored in the fvec table"""
+    last_vec_id = ""
+
+    while True:
+        results = (
+            session.query(FEmbedBlob.vec_id, FEmbedBlob.embedding)
+            .filter(FEmbedBlob.vec_id > last_vec_id)
+            .order_by(FEmbedBlob.vec_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not results:
+            break
+
+        ids = [vec_id for vec_id, _ in results]
+        matrix = np.array([blob_to_embedding(blob) for _, blob in results])
+        yield ids, matrix
+
+        last_vec_id = ids[-1]
+
+
+def build_store(session, store, batch_size=10000):
+    """Appends every embedding stored in the fvec table to the store"""
+    num_faces = 0
+
+    for ids, matrix in iter_embedding_batches(session, batch_size=batch_size):
+        store.append(ids, matrix)
+
+        num_faces += len(ids)
+        print("stored {} faces".format(num_faces))
+
+    return num_faces
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument(
+        "--store-dir",
+        type=str,
+        default="./embeddings",
+        help="directory of the embedding store",
+    )
+    args = ap.parse_args()
+
+    with SessionCM() as session:
+        build_store(session, EmbeddingStore(args.store_dir))
@@ -1,3 +1,4 @@
+import numpy as np
 from sqlalchemy.exc import IntegrityError
 from .base import Session
 
@@ -26,3 +27,18 @@ def commit_add_db_row(session, db_row):
         session.commit()
         print("* SUCESS")
         return 1
+
+
+def embedding_to_blob(embedding):
+    return np.asarray(embedding, dtype="<f4").tobytes()
+
+
+def blob_to_embedding(blob):
+    return np.frombuffer(blob, dtype="<f4")
+
+
+def loc_to_box(vec_id, face_loc):
+    """fbox row (dict) of the face location (list of its 4 values)"""
+    left, top, right, bottom = face_loc
+    return {"vec_id": vec_id, "left": left, "top": top, "right": right, "bottom": bottom}
+
@@ -1,16 +1,59 @@
+import os
 import re
 import requests
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from igramscraper.instagram import Instagram
 from .credentials import username, password
+from ..utils import ordered_map
 
 ACCOUNT_NAME_PATTERN = re.compile("(?!.*\.\.)(?!.*\.$)[^\W][\w.]{0,29}")
 INSTAGRAM = Instagram()
 
-
-def scrape_instagram_url(url, latest_post_num=0):
+# number of images downloaded at the same time
+DOWNLOAD_WORKERS = 8
+# seconds to wait for the server to connect / send data
+DOWNLOAD_TIMEOUT = (5, 30)
+# size of the chunks in which the images are streamed
+CHUNK_SIZE = 64 * 1024
+
+
+def make_session(pool_size=DOWNLOAD_WORKERS, retries=3, backoff_factor=0.5):
+    """requests session that keeps up to pool_size connections alive (per host)
+    and retries failed requests (connection errors, 429 and 5xx responses)
+    with exponential backoff
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = make_session()
+
+
+def scrape_instagram_url(
+    url,
+    latest_post_num=0,
+    download=True,
+    spool_dir=None,
+    download_workers=DOWNLOAD_WORKERS,
+):
     account_name = extract_account_name_from_url(url)
-    for data in scrape_instagram_account(account_name, latest_post_num):
+    for data in scrape_instagram_account(
+        account_name, latest_post_num, download, spool_dir, download_workers
+    ):
         yield data
 
 
@@ -27,13 +70,82 @@ def extract_account_name_from_url(url):
     return account_name
 
 
-def download_image(url, filepath):
-    img_data = requests.get(url).content
-    with open(filepath, "wb") as handler:
-        handler.write(img_data)
+def fetch_image(url, session=None):
+    """returns the (encoded) bytes of the image at url"""
+    session = session or SESSION
+
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        return b"".join(response.iter_content(CHUNK_SIZE))
+
+
+def download_image(url, filepath, session=None):
+    """streams the image at url into filepath"""
+    session = session or SESSION
+
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(filepath, "wb") as handler:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                handler.write(chunk)
+
+
+def download_items(
+    items, spool_dir=None, download_workers=DOWNLOAD_WORKERS, session=None
+):
+    """downloads the images of the (img_id, post_url, img_url) items with
+    download_workers threads (sharing the connections of one session)
+
+    yields (img_id, post_url, img_url, image) in the order of the items, where image
+    is the image as bytes or, when a spool_dir is given, the path of the image in spool_dir
+    """
+    session = session or SESSION
+
+    def download(item):
+        img_id, post_url, img_url = item
+
+        if spool_dir:
+            image = os.path.join(spool_dir, "{}.jpg".format(img_id))
+            download_image(img_url, image, session)
+        else:
+            image = fetch_image(img_url, session)
 
+        return img_id, post_url, img_url, image
 
-def scrape_instagram_account(account_name, latest_post_num=0):
+    with ThreadPoolExecutor(download_workers) as pool:
+        for data in ordered_map(pool, download, items, 2 * download_workers):
+            yield data
+
+
+def scrape_instagram_account(
+    account_name,
+    latest_post_num=0,
+    download=True,
+    spool_dir=None,
+    download_workers=DOWNLOAD_WORKERS,
+):
+    """yields (img_id, post_url, img_url, image) for every new image of the account
+    (in post order)
+
+    image is the downloaded image as bytes or, when a spool_dir is given, the path of
+    the file in spool_dir to which the image was saved (the caller deletes it).
+    The images are downloaded by download_workers threads (see download_items).
+    With download=False the images are not downloaded (image is None)
+    and the caller is responsible for fetching img_url
+    """
+    items = iter_instagram_media(account_name, latest_post_num)
+
+    if not download:
+        for img_id, item_url, image_url in items:
+            yield img_id, item_url, image_url, None
+        return
+
+    for data in download_items(items, spool_dir, download_workers):
+        yield data
+
+
+def iter_instagram_media(account_name, latest_post_num=0):
+    """yields (img_id, post_url, img_url) for every new image of the account"""
     INSTAGRAM.with_credentials(username, password)
     INSTAGRAM.login(True, True)
 
@@ -51,16 +163,13 @@ def scrape_instagram_account(account_name, latest_post_num=0):
         if item.type != "image":
             continue
 
-        # img_id, post_url, img_url, saved_img_path
+        # img_id, post_url, img_url
         # img_id = "<timestamp>_<instagram>_<account_name>_<img_num>"
 
         image_url = item.image_high_resolution_url
         item_url = item.link
         timestamp = item.created_time
 
-        image_path = "image.jpg"
-        download_image(image_url, image_path)
-
         img_id = "{}_{}_{}_{}".format(timestamp, "instagram", account_name, item_num)
 
-        yield img_id, item_url, image_url, image_path
+        yield img_id, item_url, image_url
@@ -0,0 +1,323 @@
+"""
+Recall / latency benchmark of the LSH indexes on synthetic face-like embeddings
+
+The embeddings are generated around random identities (clusters) with roughly the
+same norms and intra-person distances as the 128-d face_recognition encodings.
+For every index configuration it measures
+    - ingest throughput (faces / second)
+    - query latency (candidate generation + re-ranking) p50 / p99
+    - candidate set size
+    - recall@k against the exact (brute force) k nearest neighbours
+and writes a machine-readable json report.
+
+The SQL indexes are built in a temporary sqlite database and the
+re-ranking uses an in-memory mapper, so only the index itself is measured.
+
+usage:
+    python -m core.LSH.benchmark --sizes 10000 100000 --num-tables 49 20 --hash-size 7 --probes 0 20 --euc-window 1 2 4 --output report.json
+"""
+import sys
+import json
+import time
+import shutil
+import contextlib
+import pathlib
+import argparse
+import platform
+import tempfile
+import itertools
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .base import Base
+from .lsh import DiskLSH, SQLDiskLSH, rank_matches
+from .utils import batch_mapper
+from .config import NUM_TABLES, HASH_SIZE, EMBEDDING_SIZE, EUC_WINDOW
+
+
+def generate_embeddings(
+    num_faces,
+    embedding_size=EMBEDDING_SIZE,
+    faces_per_identity=10,
+    intra_distance=0.35,
+    seed=0,
+):
+    """generates clustered embeddings; faces of the same identity are about
+    intra_distance apart from the identity center and the norms are close to 1
+
+    Returns: (matrix of embeddings, identity of every embedding, identity centers)
+    """
+    rng = np.random.default_rng(seed)
+    num_identities = max(1, num_faces // faces_per_identity)
+
+    centers = rng.standard_normal((num_identities, embedding_size))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    centers *= rng.normal(1.0, 0.05, size=(num_identities, 1))
+
+    identities = rng.integers(0, num_identities, size=num_faces)
+    noise_std = intra_distance / np.sqrt(embedding_size)
+    embeddings = centers[identities] + rng.normal(
+        0, noise_std, size=(num_faces, embedding_size)
+    )
+
+    return embeddings.astype(np.float32), identities, centers
+
+
+def generate_queries(centers, num_queries, intra_distance=0.35, seed=1):
+    """new (not indexed) faces of the known identities"""
+    rng = np.random.default_rng(seed)
+    identities = rng.integers(0, len(centers), size=num_queries)
+    noise_std = intra_distance / np.sqrt(centers.shape[1])
+    queries = centers[identities] + rng.normal(
+        0, noise_std, size=(num_queries, centers.shape[1])
+    )
+    return queries.astype(np.float32)
+
+
+def exact_neighbours(embeddings, queries, k, block_size=256):
+    """row numbers of the exact k nearest embeddings of every query (brute force)"""
+    sq_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+
+    neighbours = []
+    for start in range(0, len(queries), block_size):
+        block = queries[start : start + block_size]
+        dists = sq_norms[None, :] - 2 * np.matmul(block, embeddings.T)
+        top = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        neighbours.extend(set(row) for row in top)
+
+    return neighbours
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+class BenchSessionCM:
+    """SessionCM for the temporary benchmark database"""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        self.session = self.session_factory()
+        return self.session
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.session.close()
+
+
+class SQLEngine:
+    """SQLDiskLSH in a temporary sqlite database (optionally with the in-memory bucket index)"""
+
+    def __init__(self, workdir, num_tables, hash_size, seed=None, memory_index=False):
+        engine = create_engine("sqlite:///{}".format(workdir / "bench.sqlite"))
+        Base.metadata.create_all(engine)
+
+        self.session_cm = BenchSessionCM(sessionmaker(bind=engine))
+        self.lsh = SQLDiskLSH(
+            num_tables=num_tables,
+            hash_size=hash_size,
+            session_cm=self.session_cm,
+            seed=seed,
+        )
+        self.memory_index = memory_index
+
+    def add_many(self, ids, matrix):
+        with self.session_cm() as session:
+            self.lsh.add_many(session, ids, matrix)
+
+    def finish_ingest(self):
+        if self.memory_index:
+            with self.session_cm() as session:
+                self.lsh.load_memory_index(session=session)
+
+    def get_local_ids(self, arr, probes, euc_window):
+        with self.session_cm() as session:
+            return self.lsh.get_local_ids(
+                session, arr, probes=probes, euc_window=euc_window
+            )
+
+
+class DiskEngine:
+    """DiskLSH in a temporary directory (doesn't support multi-probe)"""
+
+    supports_probes = False
+
+    def __init__(self, workdir, num_tables, hash_size, seed=None):
+        self.lsh = DiskLSH(workdir / "index")
+        self.lsh.set_params(num_tables, hash_size, EMBEDDING_SIZE, seed=seed)
+
+    def add_many(self, ids, matrix):
+        for id, arr in zip(ids, matrix):
+            self.lsh.add(id, arr)
+
+    def finish_ingest(self):
+        pass
+
+    def get_local_ids(self, arr, probes, euc_window):
+        return self.lsh.get_local_ids(arr, euc_window=euc_window)
+
+
+# every engine is built with the same hash tables for the same seed
+ENGINES = {
+    "sql": lambda workdir, num_tables, hash_size, seed: SQLEngine(
+        workdir, num_tables, hash_size, seed
+    ),
+    "sql-memory": lambda workdir, num_tables, hash_size, seed: SQLEngine(
+        workdir, num_tables, hash_size, seed, memory_index=True
+    ),
+    "disk": DiskEngine,
+}
+
+
+def run_benchmark(
+    engine_name,
+    embeddings,
+    queries,
+    truth,
+    num_tables,
+    hash_size,
+    probes_list,
+    euc_windows=(EUC_WINDOW,),
+    k=10,
+    batch_size=1000,
+    seed=None,
+):
+    """seed: seed of the hash tables of the index (None for random hash tables)"""
+    ids = ["face{}".format(i) for i in range(len(embeddings))]
+    rows = {id: row_num for row_num, id in enumerate(ids)}
+
+    @batch_mapper
+    def mapper(face_ids):
+        return embeddings[[rows[id] for id in face_ids]]
+
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="lsh_bench_"))
+    try:
+        engine = ENGINES[engine_name](workdir, num_tables, hash_size, seed)
+
+        start = time.perf_counter()
+        for batch_start in range(0, len(embeddings), batch_size):
+            engine.add_many(
+                ids[batch_start : batch_start + batch_size],
+                embeddings[batch_start : batch_start + batch_size].astype(np.float64),
+            )
+        engine.finish_ingest()
+        ingest_seconds = time.perf_counter() - start
+
+        if not getattr(engine, "supports_probes", True):
+            probes_list = [0]
+
+        results = []
+        for probes, euc_window in itertools.product(probes_list, euc_windows):
+            latencies, candidates, recalls = [], [], []
+
+            for query, true_rows in zip(queries, truth):
+                query = query.astype(np.float64)
+
+                start = time.perf_counter()
+                local_ids = engine.get_local_ids(query, probes, euc_window)
+                matches = rank_matches(mapper, local_ids, query, k)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+                candidates.append(len(local_ids))
+                found_rows = {rows[match.l_id] for match in matches}
+                recalls.append(len(found_rows & true_rows) / len(true_rows))
+
+            results.append(
+                {
+                    "engine": engine_name,
+                    "num_faces": len(embeddings),
+                    "num_tables": num_tables,
+                    "hash_size": hash_size,
+                    "probes": probes,
+                    "euc_window": euc_window,
+                    "k": k,
+                    "ingest_seconds": ingest_seconds,
+                    "ingest_faces_per_second": len(embeddings) / ingest_seconds,
+                    "query_latency_ms": {
+                        "mean": float(np.mean(latencies)),
+                        "p50": percentile(latencies, 50),
+                        "p99": percentile(latencies, 99),
+                    },
+                    "candidates": {
+                        "mean": float(np.mean(candidates)),
+                        "p50": percentile(candidates, 50),
+                        "p99": percentile(candidates, 99),
+                    },
+                    "recall_at_k": float(np.mean(recalls)),
+                }
+            )
+            print(json.dumps(results[-1]), file=sys.stderr)
+
+        return results
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 1000000])
+    ap.add_argument("--engines", nargs="+", choices=sorted(ENGINES), default=["sql"])
+    ap.add_argument("--num-tables", nargs="+", type=int, default=[NUM_TABLES])
+    ap.add_argument("--hash-size", nargs="+", type=int, default=[HASH_SIZE])
+    ap.add_argument("--probes", nargs="+", type=int, default=[0])
+    ap.add_argument("--euc-window", nargs="+", type=int, default=[EUC_WINDOW])
+    ap.add_argument("--num-queries", type=int, default=200)
+    ap.add_argument("-k", type=int, default=10)
+    ap.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the embeddings, the queries and the hash tables",
+    )
+    ap.add_argument(
+        "--output", type=str, default=None, help="json report path (default: stdout)"
+    )
+    args = ap.parse_args()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "args": vars(args),
+        "results": [],
+    }
+
+    # the indexes print their progress (Eg: "ADDING: ...") to stdout, which
+    # must only contain the report
+    with contextlib.redirect_stdout(sys.stderr):
+        for size in args.sizes:
+            embeddings, _, centers = generate_embeddings(size, seed=args.seed)
+            queries = generate_queries(centers, args.num_queries, seed=args.seed + 1)
+            truth = exact_neighbours(embeddings, queries, args.k)
+
+            for engine_name, num_tables, hash_size in itertools.product(
+                args.engines, args.num_tables, args.hash_size
+            ):
+                report["results"].extend(
+                    run_benchmark(
+                        engine_name,
+                        embeddings,
+                        queries,
+                        truth,
+                        num_tables,
+                        hash_size,
+                        args.probes,
+                        euc_windows=args.euc_window,
+                        k=args.k,
+                        seed=args.seed,
+                    )
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
@@ -1,3 +1,19 @@
 NUM_TABLES = 49
 HASH_SIZE = 7
 EMBEDDING_SIZE = 128
+
+# number of extra buckets probed per query (multi-probe LSH); 0 disables multi-probe
+NUM_PROBES = 0
+
+# faces whose norms are within EUC_WINDOW euclidean buckets (of width 0.1)
+# of the query norm are candidates
+EUC_WINDOW = 2
+# largest euc_window a query (Eg: of the server) may ask for
+MAX_EUC_WINDOW = 2 * EUC_WINDOW
+
+# index used by core.main.make_index (and the server):
+# "lsh" (SQLDiskLSH), "exact" (ExactIndex) or "ivfpq" (IVFPQIndex)
+INDEX_TYPE = "lsh"
+
+# file of the trained IVFPQIndex (see core/LSH/ivfpq.py)
+IVFPQ_INDEX_FILE = "./ivfpq.npz"
@@ -0,0 +1,151 @@
+import numpy as np
+
+from .lsh import ENCDIST
+from .config import EMBEDDING_SIZE
+
+
+class ExactIndex:
+    """
+    Exact (brute force) nearest neighbour search over all the stored embeddings
+
+    The embeddings are kept in a single contiguous float32 matrix and the distances
+    are computed block by block (block_size rows at a time) with
+    ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab, which is a single matrix product per block.
+
+    Has the same add / add_many / query surface as SQLDiskLSH. The index only lives
+    in memory; the FaceData database (or an embedding store) is its persistent copy
+    (see core.main.make_index)
+    """
+
+    def __init__(self, embedding_size=EMBEDDING_SIZE, block_size=8192):
+        self.embedding_size = embedding_size
+        self.block_size = block_size
+
+        # _matrix and _sq_norms are views of the first len(self) rows of the buffers,
+        # whose capacity is doubled when they are full (so adds are amortized O(1))
+        self._matrix_buffer = np.empty((0, embedding_size), dtype=np.float32)
+        self._sq_norms_buffer = np.empty(0, dtype=np.float32)
+        self._matrix = self._matrix_buffer
+        self._sq_norms = self._sq_norms_buffer
+        self._ids = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    @classmethod
+    def from_matrix(cls, ids, matrix, block_size=8192):
+        """creates the index from an existing (N x embedding_size) matrix;
+        a float32 matrix (Eg: the memory-mapped matrix of an EmbeddingStore) is used without copying it
+        """
+        matrix = np.asarray(matrix)
+        index = cls(embedding_size=matrix.shape[1], block_size=block_size)
+
+        if matrix.dtype != np.float32:
+            matrix = matrix.astype(np.float32)
+
+        # the buffers are copied (into writable arrays) on the first add
+        index._matrix_buffer = index._matrix = matrix
+        index._sq_norms_buffer = index._sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+        index._ids = list(ids)
+        index._rows = {id: row_num for row_num, id in enumerate(index._ids)}
+        return index
+
+    def add(self, session, id, arr):
+        """session is unused; it is only there to match SQLDiskLSH.add"""
+        self.add_many(session, [id], np.expand_dims(arr, axis=0))
+
+    def add_many(self, session, ids, matrix):
+        """Adds the embeddings (rows of the matrix) of the given ids.
+        ids that are already present are skipped
+        """
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.embedding_size)
+
+        new_rows = []
+        for row_num, id in enumerate(ids):
+            id = str(id)
+            if id not in self._rows:
+                self._rows[id] = len(self._ids)
+                self._ids.append(id)
+                new_rows.append(row_num)
+
+        if not new_rows:
+            return
+
+        new_matrix = matrix[new_rows]
+        start, end = len(self._matrix), len(self._ids)
+        self._reserve(end)
+
+        self._matrix_buffer[start:end] = new_matrix
+        self._sq_norms_buffer[start:end] = np.einsum("ij,ij->i", new_matrix, new_matrix)
+        self._matrix = self._matrix_buffer[:end]
+        self._sq_norms = self._sq_norms_buffer[:end]
+
+    def _reserve(self, num_rows):
+        """grows the buffers (at least doubling them) to hold num_rows rows"""
+        if len(self._matrix_buffer) >= num_rows:
+            return
+
+        capacity = max(num_rows, 2 * len(self._matrix_buffer), 1024)
+
+        matrix_buffer = np.empty((capacity, self.embedding_size), dtype=np.float32)
+        matrix_buffer[: len(self._matrix)] = self._matrix
+        sq_norms_buffer = np.empty(capacity, dtype=np.float32)
+        sq_norms_buffer[: len(self._sq_norms)] = self._sq_norms
+
+        self._matrix_buffer = matrix_buffer
+        self._sq_norms_buffer = sq_norms_buffer
+
+    def query(self, session, mapper, arr, k=10):
+        """returns the k closest embeddings as a sorted list of ENCDIST
+
+        session and mapper are unused (the embeddings are held by the index);
+        they are only there to match SQLDiskLSH.query
+        """
+        return self.query_many(session, mapper, np.expand_dims(arr, axis=0), k=k)[0]
+
+    def query_many(self, session, mapper, matrix, k=10):
+        """query for a batch of embeddings (each row of the matrix is an embedding);
+        every block of the index is compared to all the rows with one matrix product
+
+        Returns: list with the k closest embeddings (sorted list of ENCDIST) of every row
+        """
+        queries = np.asarray(matrix, dtype=np.float32).reshape(-1, self.embedding_size)
+        if len(self._ids) == 0 or k <= 0:
+            return [[] for _ in queries]
+
+        queries_sq_norms = np.einsum("ij,ij->i", queries, queries)
+
+        best_rows, best_dists = [], []
+        for start in range(0, len(self._ids), self.block_size):
+            block = self._matrix[start : start + self.block_size]
+            dists = (
+                self._sq_norms[None, start : start + self.block_size]
+                + queries_sq_norms[:, None]
+                - 2 * np.matmul(queries, block.T)
+            )
+
+            if dists.shape[1] > k:
+                top = np.argpartition(dists, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(dists.shape[1]), dists.shape)
+
+            best_rows.append(top + start)
+            best_dists.append(np.take_along_axis(dists, top, axis=1))
+
+        best_rows = np.concatenate(best_rows, axis=1)
+        best_dists = np.concatenate(best_dists, axis=1)
+
+        order = np.argsort(best_dists, axis=1, kind="stable")[:, :k]
+        return [
+            [
+                ENCDIST(
+                    self._ids[row_best_rows[i]],
+                    float(np.sqrt(max(float(row_best_dists[i]), 0.0))),
+                )
+                for i in row_order
+            ]
+            for row_order, row_best_rows, row_best_dists in zip(
+                order, best_rows, best_dists
+            )
+        ]
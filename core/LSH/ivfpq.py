@@ -0,0 +1,489 @@
+"""
+IVF-PQ (inverted file with product quantization) index for very large collections
+
+    - a coarse k-means quantizer splits the embeddings into nlist inverted lists
+    - the residual of every embedding (its difference to the centroid of its list)
+      is compressed into m one-byte product quantization codes (the residual is
+      split into m sub-vectors and each sub-vector is replaced by the id of the
+      closest of the 256 centroids of its sub-space)
+    - a query only scans the nprobe lists closest to it; the distance to every
+      code of a list is looked up in a (m x 256) asymmetric distance table that
+      is computed once per probed list (from the residual of the query to the
+      centroid of the list)
+    - optionally, the `rerank` best candidates are re-ranked with their exact
+      embeddings fetched through the mapper
+
+The ids are kept as a single utf-8 blob with an offset table. With m = 16 every face
+costs 16 bytes of codes, its list number, an offset, a 64 bit id hash (to skip
+duplicate ids) and the bytes of its id, instead of the full 128 float vector.
+
+usage (train and fill the index from the FaceData database or an embedding store):
+    python -m core.LSH.ivfpq --output ./ivfpq.npz [--embedding-store DIR] [--nlist 1024] [--m 16]
+"""
+import hashlib
+import argparse
+
+import numpy as np
+
+from .lsh import top_k_matches
+from .utils import map_embeddings
+from .config import EMBEDDING_SIZE
+
+PQ_CENTROIDS = 256
+
+# number of new id hashes kept in a set before they are merged into the sorted array
+MAX_RECENT_IDS = 100000
+
+
+class NotTrained(Exception):
+    pass
+
+
+def nearest_centroids(data, centroids, block_size=16384):
+    """index of the closest centroid of every row of data"""
+    centroid_sq_norms = np.einsum("ij,ij->i", centroids, centroids)
+
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = data[start : start + block_size]
+        dists = centroid_sq_norms[None, :] - 2 * np.matmul(block, centroids.T)
+        assignments[start : start + block_size] = np.argmin(dists, axis=1)
+
+    return assignments
+
+
+def kmeans(data, k, iterations=20, seed=0):
+    """Lloyd's k-means; returns the (k x dim) centroids"""
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+
+    if len(data) < k:
+        raise ValueError(
+            "At least {} training vectors are needed; got {}".format(k, len(data))
+        )
+
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(data, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=k)
+
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+        # empty clusters are re-seeded with random training vectors
+        num_empty = np.sum(~non_empty)
+        if num_empty:
+            centroids[~non_empty] = data[rng.choice(len(data), num_empty, replace=False)]
+
+    return centroids
+
+
+def id_hash(id):
+    """64 bit hash of an id (the chance of a collision among 10^7 ids is ~10^-5)"""
+    digest = hashlib.blake2b(id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def reserve(buffer, num_rows):
+    """returns the buffer grown (at least doubled) to hold num_rows rows"""
+    if len(buffer) >= num_rows:
+        return buffer
+
+    grown = np.empty(
+        (max(num_rows, 2 * len(buffer), 1024),) + buffer.shape[1:], dtype=buffer.dtype
+    )
+    grown[: len(buffer)] = buffer
+    return grown
+
+
+def sample_batches(batches, num_rows, sample_size, seed=0):
+    """returns sample_size random rows of the (ids, matrix) batches,
+    which hold num_rows rows in total, without keeping all the batches in memory
+    """
+    rng = np.random.default_rng(seed)
+    positions = np.sort(rng.choice(num_rows, min(sample_size, num_rows), replace=False))
+
+    sample = []
+    start = 0
+    for _, matrix in batches:
+        end = start + len(matrix)
+        low, high = np.searchsorted(positions, [start, end])
+        sample.append(np.asarray(matrix, dtype=np.float32)[positions[low:high] - start])
+        start = end
+
+    return np.concatenate(sample)
+
+
+class IVFPQIndex:
+    """
+    Args:
+        nlist: number of inverted lists (coarse centroids)
+        m: number of sub-quantizers (bytes per code); must divide embedding_size
+        nprobe: default number of inverted lists scanned per query
+        rerank: default number of candidates re-ranked with their exact embeddings
+            (0 disables the re-ranking)
+    """
+
+    def __init__(
+        self, embedding_size=EMBEDDING_SIZE, nlist=1024, m=16, nprobe=16, rerank=100
+    ):
+        if embedding_size % m:
+            raise ValueError("m must divide the embedding size")
+
+        self.embedding_size = embedding_size
+        self.nlist = nlist
+        self.m = m
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+        self.coarse_centroids = None
+        self.codebooks = None
+        # indexes saved by older versions encode the embeddings instead of the residuals
+        self.by_residual = True
+
+        # the first _size rows of the buffers are used (see reserve)
+        self._size = 0
+        self._codes = np.empty((0, m), dtype=np.uint8)
+        self._lists = np.empty(0, dtype=np.int32)
+
+        # the id of row i is _id_data[_id_offsets[i] : _id_offsets[i + 1]]
+        self._id_data = bytearray()
+        self._id_offsets = np.zeros(1, dtype=np.int64)
+
+        # hashes of the indexed ids: a sorted array and a set of the recent ones
+        self._known_ids = np.empty(0, dtype=np.int64)
+        self._recent_ids = set()
+
+        # rows sorted by inverted list (rebuilt lazily after adds)
+        self._order = None
+        self._offsets = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def is_trained(self):
+        return self.coarse_centroids is not None
+
+    @property
+    def sub_size(self):
+        return self.embedding_size // self.m
+
+    def train(self, sample, iterations=20, seed=0):
+        """learns the coarse centroids and the product quantization codebooks
+        (of the residuals) from a representative sample of embeddings
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+
+        self.coarse_centroids = kmeans(sample, self.nlist, iterations, seed)
+        residuals = sample - self.coarse_centroids[
+            nearest_centroids(sample, self.coarse_centroids)
+        ]
+
+        self.codebooks = np.stack(
+            [
+                kmeans(
+                    residuals[:, j * self.sub_size : (j + 1) * self.sub_size],
+                    PQ_CENTROIDS,
+                    iterations,
+                    seed + j + 1,
+                )
+                for j in range(self.m)
+            ]
+        )
+        self.by_residual = True
+
+    def encode(self, matrix, lists=None):
+        """product quantization codes (N x m uint8) of the rows of the matrix
+
+        lists: inverted list of every row (computed if not given)
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if self.by_residual:
+            if lists is None:
+                lists = nearest_centroids(matrix, self.coarse_centroids)
+            matrix = matrix - self.coarse_centroids[lists]
+
+        codes = np.empty((len(matrix), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub_vectors = matrix[:, j * self.sub_size : (j + 1) * self.sub_size]
+            codes[:, j] = nearest_centroids(sub_vectors, self.codebooks[j])
+
+        return codes
+
+    def add(self, session, id, arr):
+        """session is unused; it is only there to match SQLDiskLSH.add"""
+        self.add_many(session, [id], np.expand_dims(arr, axis=0))
+
+    def add_many(self, session, ids, matrix):
+        """Adds the embeddings (rows of the matrix) of the given ids.
+        ids that are already present are skipped
+        """
+        if not self.is_trained:
+            raise NotTrained("The index must be trained before adding embeddings")
+
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.embedding_size)
+
+        new_rows, new_ids = [], []
+        for row_num, id in enumerate(ids):
+            id = str(id)
+            hashed_id = id_hash(id)
+            if hashed_id in self._recent_ids or self._is_known(hashed_id):
+                continue
+
+            self._recent_ids.add(hashed_id)
+            new_rows.append(row_num)
+            new_ids.append(id.encode("utf-8"))
+
+        if len(self._recent_ids) > MAX_RECENT_IDS:
+            self._merge_recent_ids()
+
+        if not new_rows:
+            return
+
+        matrix = matrix[new_rows]
+        lists = nearest_centroids(matrix, self.coarse_centroids)
+
+        start, end = self._size, self._size + len(new_rows)
+        self._codes = reserve(self._codes, end)
+        self._codes[start:end] = self.encode(matrix, lists)
+        self._lists = reserve(self._lists, end)
+        self._lists[start:end] = lists
+
+        self._id_offsets = reserve(self._id_offsets, end + 1)
+        self._id_offsets[start + 1 : end + 1] = self._id_offsets[start] + np.cumsum(
+            [len(id) for id in new_ids]
+        )
+        self._id_data.extend(b"".join(new_ids))
+
+        self._size = end
+        self._order = None
+
+    def get_id(self, row):
+        return self._id_data[
+            self._id_offsets[row] : self._id_offsets[row + 1]
+        ].decode("utf-8")
+
+    def _is_known(self, hashed_id):
+        position = np.searchsorted(self._known_ids, hashed_id)
+        return (
+            position < len(self._known_ids) and self._known_ids[position] == hashed_id
+        )
+
+    def _merge_recent_ids(self):
+        recent_ids = np.fromiter(self._recent_ids, dtype=np.int64)
+        self._known_ids = np.union1d(self._known_ids, recent_ids)
+        self._recent_ids = set()
+
+    def query(self, session, mapper, arr, k=10, nprobe=None, rerank=None):
+        """returns the k closest embeddings as a sorted list of ENCDIST
+
+        the distances are approximate unless the candidates are re-ranked
+        with the mapper (a regular or batch mapper; see utils.batch_mapper)
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        if rerank is None:
+            rerank = self.rerank
+
+        if self._size == 0 or k <= 0:
+            return []
+
+        rows, dists = self._search(np.asarray(arr, dtype=np.float32), nprobe)
+        if len(rows) == 0:
+            return []
+
+        if mapper is None or rerank <= 0:
+            num_candidates = min(k, len(rows))
+        else:
+            num_candidates = min(max(rerank, k), len(rows))
+
+        top = np.argpartition(dists, num_candidates - 1)[:num_candidates]
+        ids = [self.get_id(row) for row in rows[top]]
+
+        if mapper is None or rerank <= 0:
+            return top_k_matches(ids, np.sqrt(np.maximum(dists[top], 0)), k)
+
+        # re-rank the best candidates with their exact embeddings
+
+        encodings = map_embeddings(mapper, ids)
+        exact_dists = np.linalg.norm(encodings - np.asarray(arr), axis=1)
+        return top_k_matches(ids, exact_dists, k)
+
+    def _search(self, arr, nprobe):
+        """returns the rows of the nprobe closest inverted lists and
+        their approximate squared distances to arr
+        """
+        self._build_inverted_lists()
+
+        coarse_dists = np.sum((self.coarse_centroids - arr) ** 2, axis=1)
+        nprobe = min(nprobe, self.nlist)
+        probed = np.argpartition(coarse_dists, nprobe - 1)[:nprobe]
+
+        table = None
+        if not self.by_residual:
+            table = self._distance_table(arr)
+
+        rows, dists = [], []
+        for l in probed:
+            list_rows = self._order[self._offsets[l] : self._offsets[l + 1]]
+            if len(list_rows) == 0:
+                continue
+
+            if self.by_residual:
+                table = self._distance_table(arr - self.coarse_centroids[l])
+
+            codes = self._codes[list_rows]
+            rows.append(list_rows)
+            dists.append(table[np.arange(self.m), codes].sum(axis=1))
+
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        return np.concatenate(rows), np.concatenate(dists)
+
+    def _distance_table(self, arr):
+        """asymmetric distance table: squared distance from every sub-vector
+        of arr to every centroid of its sub-space
+        """
+        sub_queries = arr.reshape(self.m, 1, self.sub_size)
+        return np.sum((self.codebooks - sub_queries) ** 2, axis=2)
+
+    def _build_inverted_lists(self):
+        if self._order is not None:
+            return
+
+        lists = self._lists[: self._size]
+        self._order = np.argsort(lists, kind="stable")
+        self._offsets = np.searchsorted(lists[self._order], np.arange(self.nlist + 1))
+
+    def save(self, path):
+        if not self.is_trained:
+            raise NotTrained("Only a trained index can be saved")
+
+        self._merge_recent_ids()
+
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                params=np.array(
+                    [
+                        self.embedding_size,
+                        self.nlist,
+                        self.m,
+                        self.nprobe,
+                        self.rerank,
+                        int(self.by_residual),
+                    ]
+                ),
+                coarse_centroids=self.coarse_centroids,
+                codebooks=self.codebooks,
+                codes=self._codes[: self._size],
+                lists=self._lists[: self._size],
+                id_data=np.frombuffer(bytes(self._id_data), dtype=np.uint8),
+                id_offsets=self._id_offsets[: self._size + 1],
+                id_hashes=self._known_ids,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            params = data["params"].tolist()
+            embedding_size, nlist, m, nprobe, rerank = params[:5]
+            index = cls(embedding_size, nlist, m, nprobe, rerank)
+
+            # older versions (without the by_residual param) encoded the embeddings
+            index.by_residual = len(params) > 5 and bool(params[5])
+
+            index.coarse_centroids = data["coarse_centroids"]
+            index.codebooks = data["codebooks"]
+            index._codes = data["codes"]
+            index._lists = data["lists"]
+            index._size = len(index._codes)
+
+            if "id_data" in data:
+                index._id_data = bytearray(data["id_data"].tobytes())
+                index._id_offsets = data["id_offsets"]
+                index._known_ids = data["id_hashes"]
+            else:
+                # older versions saved the ids as a unicode array
+                ids = [id.encode("utf-8") for id in data["ids"].tolist()]
+                index._id_data = bytearray(b"".join(ids))
+                index._id_offsets = np.concatenate(
+                    [[0], np.cumsum([len(id) for id in ids], dtype=np.int64)]
+                )
+                index._known_ids = np.unique(
+                    np.array([id_hash(id.decode("utf-8")) for id in ids], dtype=np.int64)
+                )
+
+        return index
+
+
+if __name__ == "__main__":
+    from sqlalchemy import func
+
+    from ..FaceData.models import FEmbedBlob
+    from ..FaceData.utils import SessionCM as FaceDataSessionCM
+    from ..FaceData.store import EmbeddingStore, iter_embedding_batches
+
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument("--output", type=str, default="./ivfpq.npz")
+    ap.add_argument(
+        "--embedding-store",
+        type=str,
+        default=None,
+        help="read the embeddings from this embedding store instead of the FaceData database",
+    )
+    ap.add_argument("--nlist", type=int, default=1024)
+    ap.add_argument("--m", type=int, default=16)
+    ap.add_argument("--nprobe", type=int, default=16)
+    ap.add_argument("--rerank", type=int, default=100)
+    ap.add_argument(
+        "--train-size",
+        type=int,
+        default=100000,
+        help="number of embeddings used to train the quantizers",
+    )
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=10000,
+        help="number of embeddings read and added at a time",
+    )
+    args = ap.parse_args()
+
+    index = IVFPQIndex(
+        nlist=args.nlist, m=args.m, nprobe=args.nprobe, rerank=args.rerank
+    )
+
+    with FaceDataSessionCM() as session:
+        # the embeddings are read twice, batch by batch: once to draw the
+        # training sample and once to add them
+        if args.embedding_store:
+            store = EmbeddingStore(args.embedding_store, embedding_size=EMBEDDING_SIZE)
+            num_faces = len(store)
+
+            def iter_batches():
+                for start in range(0, num_faces, args.batch_size):
+                    yield (
+                        store.ids[start : start + args.batch_size],
+                        store.matrix[start : start + args.batch_size],
+                    )
+
+        else:
+            num_faces = session.query(func.count(FEmbedBlob.vec_id)).scalar()
+
+            def iter_batches():
+                return iter_embedding_batches(session, batch_size=args.batch_size)
+
+        index.train(sample_batches(iter_batches(), num_faces, args.train_size))
+
+        for ids, matrix in iter_batches():
+            index.add_many(None, ids, matrix)
+            print("added {} faces".format(len(index)))
+
+    index.save(args.output)
+    print("saved {} faces to {}".format(len(index), args.output))
@@ -1,24 +1,50 @@
 import os
+import time
 import pathlib
 import json
+import heapq
+import hashlib
 import numpy as np
 
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, or_
+from sqlalchemy.exc import IntegrityError
 from collections import defaultdict
 
 from .base import Base, ENGINE
-from .models import Index, HashTables
-from .utils import SessionCM, commit_add_db_row
-from .minmaxheap import MinKList
-from .config import NUM_TABLES, HASH_SIZE, EMBEDDING_SIZE
+from .models import Index, IndexV2, FaceIds, Meta, HashTables, HashTablesBlob
+from .models import BucketUpdates
+from .utils import SessionCM, commit_add_db_row, map_embeddings
+from ..utils import bulk_insert_ignore
+from .memindex import (
+    MemoryBucketIndex,
+    euclidean_key,
+    euclidean_bucket,
+    table_buckets,
+    bucket_keys,
+)
+from .config import NUM_TABLES, HASH_SIZE, EMBEDDING_SIZE, NUM_PROBES, EUC_WINDOW
 
 Base.metadata.create_all(ENGINE)
 
 
+# findex schema versions (stored in the lsh_meta table under "findex_version")
+#   SCHEMA_V1: text columns, not table aware (findex table)
+#   SCHEMA_MIGRATING: findex is being copied to findex_v2 (see migrate_findex.py);
+#       queries still use findex and new faces are written to both tables
+#   SCHEMA_V2: integer columns, table aware (findex_v2 and fids tables)
+SCHEMA_V1 = "1"
+SCHEMA_MIGRATING = "migrating"
+SCHEMA_V2 = "2"
+
+
 class NonEmptyDirectory(Exception):
     pass
 
 
+class CorruptHashTables(Exception):
+    pass
+
+
 class ENCDIST:
     def __init__(self, l_id, dist):
         self.l_id = l_id
@@ -43,6 +69,139 @@ class ENCDIST:
         return self.dist == other.dist
 
 
+def top_k_matches(ids, dists, k):
+    """returns the k ids with the smallest distances as a sorted list of ENCDIST
+    (nan distances are ignored)
+    """
+    ids = np.asarray(ids)
+    dists = np.asarray(dists)
+
+    valid = ~np.isnan(dists)
+    ids, dists = ids[valid], dists[valid]
+
+    if len(dists) > k:
+        top = np.argpartition(dists, k - 1)[:k]
+        ids, dists = ids[top], dists[top]
+
+    order = np.argsort(dists, kind="stable")
+    return [ENCDIST(str(ids[i]), float(dists[i])) for i in order]
+
+
+def rank_matches(mapper, ids, arr, k):
+    """fetches the encoding vectors of all the ids with the mapper and
+    returns the k closest ones to arr (sorted list of ENCDIST)
+    """
+    if len(ids) == 0 or k <= 0:
+        return []
+
+    encodings = map_embeddings(mapper, ids)
+    dists = np.linalg.norm(encodings - np.asarray(arr), axis=1)
+
+    return top_k_matches(ids, dists, k)
+
+
+def rank_matches_many(mapper, candidates, matrix, k):
+    """rank_matches for a batch of encoding vectors (rows of the matrix) where
+    candidates[i] are the candidate ids of matrix[i]
+
+    the encoding vectors of all the candidates are fetched with one mapper call and
+    the distances of every row to every candidate are computed as one matrix
+    (distances to ids that are not candidates of a row are ignored)
+
+    Returns: list with the k closest candidates (sorted list of ENCDIST) of every row
+    """
+    matrix = np.asarray(matrix, dtype=np.float64).reshape(len(candidates), -1)
+
+    ids = sorted(set().union(*candidates))
+    if len(ids) == 0 or k <= 0:
+        return [[] for _ in candidates]
+
+    encodings = map_embeddings(mapper, ids)
+    positions = {id: i for i, id in enumerate(ids)}
+
+    sq_dists = (
+        np.einsum("ij,ij->i", matrix, matrix)[:, None]
+        + np.einsum("ij,ij->i", encodings, encodings)[None, :]
+        - 2 * np.matmul(matrix, encodings.T)
+    )
+    dists = np.sqrt(np.maximum(sq_dists, 0))
+
+    not_candidate = np.ones(dists.shape, dtype=bool)
+    for row_num, row_candidates in enumerate(candidates):
+        not_candidate[row_num, [positions[id] for id in row_candidates]] = False
+    dists[not_candidate] = np.nan
+
+    ids = np.asarray(ids)
+    return [top_k_matches(ids, row_dists, k) for row_dists in dists]
+
+
+def stack_hash_tables(hash_tables):
+    """Stack the (embedding_size, hash_size) hash tables side by side into a single
+    (embedding_size, num_tables * hash_size) projection matrix, so that every
+    hash table can be applied to a batch of embeddings with one matmul
+    """
+    return np.hstack(hash_tables)
+
+
+def pack_hash_bits(projected, hash_size):
+    """Convert the projected embeddings into integer bucket codes (one per hash table)
+
+    Args:
+        projected: matrix of shape (num_vectors, num_tables * hash_size) as returned by
+            multiplying the embeddings with the stacked projection matrix
+        hash_size: number of bits per hash table
+    Returns: integer matrix of shape (num_vectors, num_tables) where every bit of a code
+        is 1 if the corresponding projected value is positive. The first projected value
+        of a table is the most significant bit
+    """
+    bits = projected.reshape(projected.shape[0], -1, hash_size) > 0
+    shifts = np.arange(hash_size - 1, -1, -1, dtype=np.int64)
+    return np.bitwise_or.reduce(bits.astype(np.int64) << shifts, axis=-1)
+
+
+def probe_sequence(margins, probes):
+    """Multi-probe LSH: returns the `probes` most promising bit flips over all the hash tables
+
+    The cost of flipping a bit is the squared margin (distance of the projected value
+    from the hyperplane) and the cost of flipping several bits of the same table is the
+    sum of their costs. The perturbations are generated in increasing order of cost with
+    the shift/expand heap of query-directed probing (Lv et al. 2007)
+
+    Args:
+        margins: matrix of shape (num_tables, hash_size) with the absolute projected values
+        probes: number of perturbations to return
+    Returns: list of (htno, mask) where hash ^ mask is the bucket to probe in table htno
+    """
+    num_tables, hash_size = margins.shape
+
+    # positions of the bits of every table from the smallest margin to the largest
+    order = np.argsort(margins, axis=1)
+    costs = np.take_along_axis(margins, order, axis=1) ** 2
+
+    heap = [(costs[htno, 0], htno, (0,)) for htno in range(num_tables)]
+    heapq.heapify(heap)
+
+    perturbations = []
+    while heap and len(perturbations) < probes:
+        cost, htno, flipped = heapq.heappop(heap)
+
+        mask = 0
+        for position in flipped:
+            mask |= 1 << (hash_size - 1 - int(order[htno, position]))
+        perturbations.append((htno, mask))
+
+        last = flipped[-1]
+        if last + 1 < hash_size:
+            # shift: flip the next bit instead of the last one
+            shifted_cost = cost - costs[htno, last] + costs[htno, last + 1]
+            heapq.heappush(heap, (shifted_cost, htno, flipped[:-1] + (last + 1,)))
+            # expand: flip the next bit as well
+            expanded_cost = cost + costs[htno, last + 1]
+            heapq.heappush(heap, (expanded_cost, htno, flipped + (last + 1,)))
+
+    return perturbations
+
+
 class DiskLSH:
     """
     Disk based Locality Sensitive Hashing using Random Projection with Multiple hash tables
@@ -54,8 +213,9 @@ class DiskLSH:
         self.bucket_dir = self.index_dir / "buckets"
         self.params_file = self.index_dir / "params.json"
         self.global_idx_file = self.index_dir / "global_idx.txt"
+        self._projection = None
 
-    def set_params(self, num_tables, hash_size, embedding_size):
+    def set_params(self, num_tables, hash_size, embedding_size, seed=None):
         """
         This method will save the given params to a json file inside <index_dir>
         and also generate and save the hash tables inside <index_dir>/hash_tables
@@ -64,6 +224,7 @@ class DiskLSH:
             num_tables: number of hash tables (random projection)
             hash_size: number of bits (or) number of output dimensions; Eg: 128 length input vector will be converted to a 8 bit index
             embedding_size: the length of each embedding vector; Eg: 128
+            seed: (optional) seed of the random hash tables
         """
         if os.path.isdir(self.index_dir) and os.listdir(self.index_dir):
             raise NonEmptyDirectory("The folder specified by index_dir must be empty")
@@ -78,7 +239,8 @@ class DiskLSH:
         self.bucket_dir.mkdir(parents=True, exist_ok=True)
 
         self._save_params()
-        self._generate_hash_tables()
+        self._generate_hash_tables(seed)
+        self._projection = None
 
     def add(self, id, arr):
         """Index the given vector (or matrix) by calculating and storing the hash
@@ -104,32 +266,32 @@ class DiskLSH:
                 f.write(str(id))
                 f.write("\n")
 
-    def query(self, mapper, arr, k=10):
+    def query(self, mapper, arr, k=10, euc_window=None):
         """
         mapper is a function which takes id as input and gives the
-        encoding vector as output
-        """
-        matches = MinKList(k)
+        encoding vector as output (or a batch mapper, see utils.batch_mapper)
 
-        local_ids = self.get_local_ids(arr)
+        euc_window is the number of euclidean buckets on either side of the
+        query norm that are searched; defaults to EUC_WINDOW
+        """
+        local_ids = self.get_local_ids(arr, euc_window=euc_window)
         print("Found {} potential matches".format(len(local_ids)))
-        for id_num, l_id in enumerate(local_ids):
-            encoding_vec = mapper(l_id)
-            dist = self.euclidean(arr, encoding_vec)
 
-            matches.insert(ENCDIST(l_id, dist))
+        return rank_matches(mapper, local_ids, arr, k)
 
-            print(".", end="")
-            if id_num % 100 == 0:
-                print()
-
-        return sorted(matches.get_items())
-
-    def get_local_ids(self, arr):
+    def get_local_ids(self, arr, euc_window=None):
         """returns the ids that are present in the same hash bucket
         for the given encoding vector
         """
-        target_euc_idx = float(self.get_euclidean_index(arr).replace("d", "."))
+        if euc_window is None:
+            euc_window = EUC_WINDOW
+
+        target_euc_key = euclidean_key(self.get_euclidean_index(arr))
+        # directory names of the euclidean buckets within the window
+        euclidean_dirs = [
+            euclidean_bucket(euc_key)
+            for euc_key in range(target_euc_key - euc_window, target_euc_key + euc_window + 1)
+        ]
 
         hashes = self.get_hash(arr)
         unique_hashes = set(hashes)
@@ -138,14 +300,15 @@ class DiskLSH:
         for h in unique_hashes:
             h = str(h)
             selected_hash = self.bucket_dir / h
-            for euclidean_dir in os.listdir(selected_hash):
-                potential_euc_idx = float(euclidean_dir.replace("d", "."))
+            for euclidean_dir in euclidean_dirs:
+                idx_file = selected_hash / euclidean_dir / "idx.txt"
+                if not idx_file.exists():
+                    continue
 
-                if abs(potential_euc_idx - target_euc_idx) <= 0.2:
-                    with (selected_hash / euclidean_dir / "idx.txt").open("r") as f:
-                        for line in f:
-                            id = line.strip()
-                            ids.add(id)
+                with idx_file.open("r") as f:
+                    for line in f:
+                        id = line.strip()
+                        ids.add(id)
 
         return sorted(ids)
 
@@ -193,20 +356,8 @@ class DiskLSH:
         if dim == 1:
             arr = np.expand_dims(arr, axis=0)
 
-        hashes = [[] for _ in range(arr.shape[0])]
-
-        for hash_table_filename in os.listdir(self.hash_dir):
-            hash_table = np.load(self.hash_dir / hash_table_filename)
-            hash_mat = np.matmul(arr, hash_table)
-
-            for row_num, row in enumerate(hash_mat):
-                bit_hash = []
-                for num in row:
-                    if num > 0:
-                        bit_hash.append("1")
-                    else:
-                        bit_hash.append("0")
-                hashes[row_num].append(int("".join(bit_hash), 2))
+        projection, hash_size = self._get_projection()
+        hashes = pack_hash_bits(np.matmul(arr, projection), hash_size)
 
         if dim == 1:
             return np.squeeze(hashes, axis=0)
@@ -230,7 +381,27 @@ class DiskLSH:
         with self.params_file.open("w") as f:
             json.dump(self._params, f, indent=4, sort_keys=True)
 
-    def _generate_hash_tables(self):
+    def _get_projection(self):
+        """loads the hash tables from <index_dir>/hash_tables (only once) and returns
+        them as a single stacked projection matrix along with the hash size
+        """
+        if self._projection is None:
+            with self.params_file.open("r") as f:
+                hash_size = json.load(f)["hash_size"]
+
+            # ht<table_num>.npy files in table order
+            hash_table_filenames = sorted(
+                os.listdir(self.hash_dir), key=lambda f: int(f[2:].split(".")[0])
+            )
+            hash_tables = [
+                np.load(self.hash_dir / hash_table_filename)
+                for hash_table_filename in hash_table_filenames
+            ]
+            self._projection = (stack_hash_tables(hash_tables), hash_size)
+
+        return self._projection
+
+    def _generate_hash_tables(self, seed=None):
         """generates and saves each hash table in its own file
         Eg:
             <index_dir>/hash_tables/ht0.npy
@@ -239,13 +410,15 @@ class DiskLSH:
             .
             .
             <index_dir>/hash_tables/ht<num_tables>.npy
-        """
 
+        the tables are the same as the ones generated by SQLDiskLSH with the same seed
+        """
+        rng = np.random.default_rng(seed)
         for table_num in range(self._params["num_tables"]):
             np.save(
                 (self.hash_dir / "ht{}.npy".format(table_num)),
-                np.random.randn(
-                    self._params["embedding_size"], self._params["hash_size"]
+                rng.standard_normal(
+                    (self._params["embedding_size"], self._params["hash_size"])
                 ),
             )
 
@@ -255,8 +428,45 @@ class SQLDiskLSH:
     Disk based (with SQL) Locality Sensitive Hashing using Random Projection with Multiple hash tables
     """
 
-    def __init__(self):
-        self.hash_tables = self._get_hash_tables()
+    def __init__(
+        self,
+        num_tables=NUM_TABLES,
+        hash_size=HASH_SIZE,
+        embedding_size=EMBEDDING_SIZE,
+        session_cm=SessionCM,
+        seed=None,
+    ):
+        """
+        Args:
+            num_tables, hash_size, embedding_size: shape of the hash tables that are
+                generated if the index database doesn't contain any yet
+                (otherwise the stored hash tables are used)
+            session_cm: context manager that gives a session of the index database
+            seed: (optional) seed of the generated hash tables
+        """
+        self.session_cm = session_cm
+        self.hash_tables = self._get_hash_tables(
+            num_tables, hash_size, embedding_size, seed
+        )
+        self.hash_size = self.hash_tables[0].shape[1]
+        self.projection = stack_hash_tables(self.hash_tables)
+        self.memory_index = None
+        self._schema_version = None
+
+    def load_memory_index(self, session=None, snapshot_dir=None, mmap_mode=None):
+        """Generate the candidates from an in-memory copy of the findex table
+        instead of querying the database
+
+        The in-memory index is either loaded from a snapshot (see memindex.py)
+        or built from the findex (or findex_v2) table using the given session. Faces
+        that are added afterwards are not visible until the memory index is reloaded
+        """
+        if snapshot_dir is not None:
+            self.memory_index = MemoryBucketIndex.load(snapshot_dir, mmap_mode=mmap_mode)
+        elif self.get_schema_version(session) == SCHEMA_V2:
+            self.memory_index = MemoryBucketIndex.from_db_v2(session, self.hash_size)
+        else:
+            self.memory_index = MemoryBucketIndex.from_db(session)
 
     def add(self, session, id, arr):
         """Index the given vector (or matrix) by calculating and storing the hash
@@ -264,49 +474,227 @@ class SQLDiskLSH:
 
         If arr is a matrix then each row must correspond to an embedding vector
         """
-        hashes = self.get_hash(arr)
-        unqiue_hashes = set(hashes)
+        self.add_many(session, [id], np.expand_dims(arr, axis=0))
 
-        for hash_bucket in unqiue_hashes:
-            hash_bucket = str(hash_bucket)
-            euclidean_index = self.get_euclidean_index(arr)
+    def add_many(self, session, ids, matrix, chunk_size=5000):
+        """Index a batch of embeddings (each row of the matrix is an embedding vector
+        and ids[i] is the id of matrix[i])
 
-            db_row = Index(
-                vec_id=str(id), hash_bucket=hash_bucket, euc_bucket=euclidean_index
+        All the bucket rows are written with bulk inserts (chunk_size rows per statement)
+        and committed in a single transaction. Rows that are already indexed are skipped
+        """
+        matrix = np.asarray(matrix)
+        hashes = self.get_hash(matrix)
+        euc_buckets = [self.get_euclidean_index(row) for row in matrix]
+
+        schema_version = self.get_schema_version(session)
+        if schema_version != SCHEMA_V2:
+            self._add_v1_rows(session, ids, hashes, euc_buckets, chunk_size)
+        if schema_version != SCHEMA_V1:
+            self._add_v2_rows(session, ids, hashes, euc_buckets, chunk_size)
+
+        self._touch_buckets(session, hashes, euc_buckets, chunk_size)
+
+        session.commit()
+
+    def _touch_buckets(self, session, hashes, euc_buckets, chunk_size):
+        """sets the updated_at of the buckets of the added faces to now"""
+        hashes = np.asarray(hashes, dtype=np.int64).reshape(len(euc_buckets), -1)
+        htnos = np.broadcast_to(np.arange(hashes.shape[1]), hashes.shape)
+        euc_keys = np.array([euclidean_key(e) for e in euc_buckets], dtype=np.int64)
+
+        keys = np.unique(
+            bucket_keys(
+                table_buckets(htnos, hashes, self.hash_size),
+                np.broadcast_to(euc_keys[:, None], hashes.shape),
             )
-            commit_add_db_row(session, db_row)
+        ).tolist()
+
+        # delete + insert instead of a dialect specific upsert
+        for start in range(0, len(keys), chunk_size):
+            session.query(BucketUpdates).filter(
+                BucketUpdates.bucket_key.in_(keys[start : start + chunk_size])
+            ).delete(synchronize_session=False)
+
+        updated_at = time.time()
+        bulk_insert_ignore(
+            session,
+            BucketUpdates.__table__,
+            [{"bucket_key": key, "updated_at": updated_at} for key in keys],
+            chunk_size=chunk_size,
+        )
 
-    def query(self, session, mapper, arr, k=10):
+    def get_query_buckets(self, arr, probes=None, euc_window=None):
+        """returns the keys (see BucketUpdates) of all the buckets that are looked up
+        by a query for the given encoding vector; a face added to any other bucket
+        can't change the results of the query
         """
-        mapper is a function which takes id as input and gives the
-        encoding vector as output
+        if euc_window is None:
+            euc_window = EUC_WINDOW
+
+        htnos, hashes = self.get_probe_buckets(np.asarray(arr), probes)
+        euc_key = euclidean_key(self.get_euclidean_index(arr))
+        euc_keys = np.arange(max(euc_key - euc_window, 0), euc_key + euc_window + 1)
+
+        return np.unique(
+            bucket_keys(
+                np.repeat(table_buckets(htnos, hashes, self.hash_size), len(euc_keys)),
+                np.tile(euc_keys, len(hashes)),
+            )
+        ).tolist()
+
+    def can_cache_results(self, session):
+        """whether the results of the queries can be cached (see core/resultcache.py)
+
+        the keys of the touched and queried buckets are table aware, like the buckets
+        of findex_v2; the candidates of SCHEMA_V1 and SCHEMA_MIGRATING databases are
+        looked up in findex, whose buckets aren't, so a face added to them can change
+        the results of queries that didn't look up any of its keys
         """
-        matches = MinKList(k)
+        return self.get_schema_version(session) == SCHEMA_V2
 
-        local_ids = self.get_local_ids(session, arr)
-        print("Found {} potential matches".format(len(local_ids)))
+    def get_bucket_updates(self, session, since=None):
+        """returns (keys of the buckets updated after `since`, time of the last update)
+
+        with since=None no bucket is returned; only the time of the last update
+        """
+        if since is None:
+            return [], session.query(func.max(BucketUpdates.updated_at)).scalar()
+
+        results = (
+            session.query(BucketUpdates.bucket_key, BucketUpdates.updated_at)
+            .filter(BucketUpdates.updated_at > since)
+            .all()
+        )
+        if not results:
+            return [], since
+
+        keys, updated_ats = zip(*results)
+        return list(keys), max(updated_ats)
+
+    def _add_v1_rows(self, session, ids, hashes, euc_buckets, chunk_size):
+        rows = []
+        for id, row_hashes, euclidean_index in zip(ids, hashes, euc_buckets):
+            for hash_bucket in set(row_hashes.tolist()):
+                rows.append(
+                    {
+                        "vec_id": str(id),
+                        "hash_bucket": str(hash_bucket),
+                        "euc_bucket": euclidean_index,
+                    }
+                )
 
-        for id_num, l_id in enumerate(local_ids):
-            encoding_vec = mapper(l_id)
-            dist = self.euclidean(arr, encoding_vec)
+        bulk_insert_ignore(session, Index.__table__, rows, chunk_size=chunk_size)
 
-            matches.insert(ENCDIST(l_id, dist))
+    def _add_v2_rows(self, session, ids, hashes, euc_buckets, chunk_size):
+        face_ids = self.get_face_ids(session, ids, create=True)
 
-            print(".", end="")
-            if id_num % 100 == 0:
-                print()
+        rows = []
+        for id, row_hashes, euclidean_index in zip(ids, hashes, euc_buckets):
+            face_id = face_ids[str(id)]
+            euc_bucket = euclidean_key(euclidean_index)
+
+            for htno, hash_bucket in enumerate(row_hashes.tolist()):
+                rows.append(
+                    {
+                        "htno": htno,
+                        "hash_bucket": hash_bucket,
+                        "euc_bucket": euc_bucket,
+                        "face_id": face_id,
+                    }
+                )
 
-        return sorted(matches.get_items())
+        bulk_insert_ignore(session, IndexV2.__table__, rows, chunk_size=chunk_size)
 
-    def get_local_ids(self, session, arr):
+    def get_face_ids(self, session, ids, create=False, chunk_size=500):
+        """returns a dict that maps every (known) id to its integer surrogate face_id.
+        if create is True, the ids that don't have a face_id yet are assigned one
+        """
+        ids = [str(id) for id in ids]
+
+        if create:
+            bulk_insert_ignore(
+                session, FaceIds.__table__, [{"vec_id": id} for id in set(ids)]
+            )
+
+        face_ids = {}
+        for start in range(0, len(ids), chunk_size):
+            results = (
+                session.query(FaceIds.vec_id, FaceIds.face_id)
+                .filter(FaceIds.vec_id.in_(ids[start : start + chunk_size]))
+                .all()
+            )
+            face_ids.update(results)
+
+        return face_ids
+
+    def get_schema_version(self, session):
+        """returns the findex schema version of the index database
+
+        a database without a version is either a new database (which starts at SCHEMA_V2)
+        or a database that was created before findex_v2 existed (SCHEMA_V1)
+        """
+        if self._schema_version == SCHEMA_V2:
+            return SCHEMA_V2
+
+        meta = session.query(Meta).filter(Meta.key == "findex_version").first()
+        if meta is None:
+            has_v1_rows = session.query(Index.vec_id).first() is not None
+            meta = Meta("findex_version", SCHEMA_V1 if has_v1_rows else SCHEMA_V2)
+            commit_add_db_row(session, meta)
+            meta = session.query(Meta).filter(Meta.key == "findex_version").first()
+
+        self._schema_version = meta.value
+        return meta.value
+
+    def set_schema_version(self, session, schema_version):
+        session.merge(Meta("findex_version", schema_version))
+        session.commit()
+        self._schema_version = schema_version
+
+    def query(self, session, mapper, arr, k=10, probes=None, euc_window=None):
+        """
+        mapper is a function which takes id as input and gives the
+        encoding vector as output (or a batch mapper, see utils.batch_mapper)
+
+        probes is the number of extra buckets that are probed (multi-probe LSH);
+        defaults to NUM_PROBES
+
+        euc_window is the number of euclidean buckets on either side of the
+        query norm that are searched; defaults to EUC_WINDOW
+        """
+        local_ids = self.get_local_ids(session, arr, probes=probes, euc_window=euc_window)
+        print("Found {} potential matches".format(len(local_ids)))
+
+        return rank_matches(mapper, local_ids, arr, k)
+
+    def get_local_ids(self, session, arr, probes=None, euc_window=None):
         """returns the ids that are present in the same hash bucket
-        for the given encoding vector
+        for the given encoding vector (and in the `probes` neighbouring buckets
+        that are most likely to contain its neighbours)
         """
+        if euc_window is None:
+            euc_window = EUC_WINDOW
 
         euclidean_bucket = self.get_euclidean_index(arr)
-        similar_euc_buckets = self._get_similar_euclidean_buckets(euclidean_bucket)
+        euc_key = euclidean_key(euclidean_bucket)
+        euc_low, euc_high = euc_key - euc_window, euc_key + euc_window
+
+        htnos, hashes = self.get_probe_buckets(arr, probes)
+
+        if self.memory_index is not None:
+            if self.memory_index.table_aware:
+                hashes = table_buckets(htnos, hashes, self.hash_size)
+            return self.memory_index.get_local_ids(hashes, euc_low, euc_high)
+
+        if self.get_schema_version(session) == SCHEMA_V2:
+            return self._get_local_ids_v2(session, htnos, hashes, euc_low, euc_high)
+
+        # the text euclidean buckets of findex can't be range scanned
+        similar_euc_buckets = self._get_similar_euclidean_buckets(
+            euclidean_bucket, n=euc_window
+        )
 
-        hashes = self.get_hash(arr)
         hashes = list(map(str, hashes))
 
         unique_hashes = list(set(hashes))
@@ -326,6 +714,189 @@ class SQLDiskLSH:
 
         return sorted(set(potential_matches))
 
+    def query_many(self, session, mapper, matrix, k=10, probes=None, euc_window=None):
+        """query for a batch of encoding vectors (each row of the matrix is an encoding vector)
+
+        all the rows are hashed with one matrix product, their candidates are fetched
+        with a single database query and re-ranked with a single mapper call
+
+        Returns: list with the k closest matches (sorted list of ENCDIST) of every row
+        """
+        candidates = self.get_local_ids_many(
+            session, matrix, probes=probes, euc_window=euc_window
+        )
+        print(
+            "Found {} potential matches for {} faces".format(
+                len(set().union(*candidates)), len(candidates)
+            )
+        )
+
+        return rank_matches_many(mapper, candidates, matrix, k)
+
+    def get_local_ids_many(self, session, matrix, probes=None, euc_window=None):
+        """get_local_ids for every row of the matrix
+
+        Returns: list with the sorted candidate ids of every row
+        """
+        if euc_window is None:
+            euc_window = EUC_WINDOW
+
+        matrix = np.asarray(matrix).reshape(-1, self.projection.shape[0])
+        if len(matrix) == 0:
+            return []
+
+        projected = np.matmul(matrix, self.projection)
+        buckets = [self._probe_buckets(row, probes) for row in projected]
+
+        euclidean_buckets = [self.get_euclidean_index(row) for row in matrix]
+        euc_keys = np.array([euclidean_key(e) for e in euclidean_buckets])
+
+        if self.memory_index is not None:
+            local_ids = []
+            for (htnos, hashes), euc_key in zip(buckets, euc_keys):
+                if self.memory_index.table_aware:
+                    hashes = table_buckets(htnos, hashes, self.hash_size)
+                local_ids.append(
+                    self.memory_index.get_local_ids(
+                        hashes, euc_key - euc_window, euc_key + euc_window
+                    )
+                )
+            return local_ids
+
+        if self.get_schema_version(session) == SCHEMA_V2:
+            return self._get_local_ids_many_v2(session, buckets, euc_keys, euc_window)
+
+        similar_euc_buckets = [
+            self._get_similar_euclidean_buckets(e, n=euc_window)
+            for e in euclidean_buckets
+        ]
+
+        all_hashes = set()
+        for _, hashes in buckets:
+            all_hashes.update(map(str, hashes.tolist()))
+
+        results = (
+            session.query(Index.vec_id, Index.hash_bucket, Index.euc_bucket)
+            .filter(
+                and_(
+                    Index.hash_bucket.in_(sorted(all_hashes)),
+                    Index.euc_bucket.in_(sorted(set().union(*similar_euc_buckets))),
+                )
+            )
+            .all()
+        )
+        if not results:
+            return [[] for _ in buckets]
+
+        vec_ids, row_hashes, row_euc_buckets = map(np.asarray, zip(*results))
+        row_hashes = row_hashes.astype(np.int64)
+
+        # split the rows between the faces
+        return [
+            np.unique(
+                vec_ids[
+                    np.isin(row_hashes, hashes)
+                    & np.isin(row_euc_buckets, face_euc_buckets)
+                ]
+            ).tolist()
+            for (_, hashes), face_euc_buckets in zip(buckets, similar_euc_buckets)
+        ]
+
+    def _get_local_ids_many_v2(self, session, buckets, euc_keys, euc_window):
+        all_buckets = defaultdict(set)
+        for htnos, hashes in buckets:
+            for htno, hash_bucket in zip(htnos.tolist(), hashes.tolist()):
+                all_buckets[htno].add(hash_bucket)
+
+        euc_low, euc_high = euc_keys.min() - euc_window, euc_keys.max() + euc_window
+        bucket_filters = [
+            and_(
+                IndexV2.htno == htno,
+                IndexV2.hash_bucket.in_(sorted(hash_buckets)),
+                IndexV2.euc_bucket.between(int(euc_low), int(euc_high)),
+            )
+            for htno, hash_buckets in all_buckets.items()
+        ]
+
+        results = (
+            session.query(
+                IndexV2.htno, IndexV2.hash_bucket, IndexV2.euc_bucket, FaceIds.vec_id
+            )
+            .join(FaceIds, IndexV2.face_id == FaceIds.face_id)
+            .filter(or_(*bucket_filters))
+            .all()
+        )
+        if not results:
+            return [[] for _ in buckets]
+
+        row_htnos, row_hashes, row_euc_keys, vec_ids = map(np.asarray, zip(*results))
+        row_buckets = table_buckets(row_htnos, row_hashes, self.hash_size)
+
+        # split the rows between the faces
+        return [
+            np.unique(
+                vec_ids[
+                    np.isin(row_buckets, table_buckets(htnos, hashes, self.hash_size))
+                    & (np.abs(row_euc_keys.astype(np.int64) - euc_key) <= euc_window)
+                ]
+            ).tolist()
+            for (htnos, hashes), euc_key in zip(buckets, euc_keys)
+        ]
+
+    def _get_local_ids_v2(self, session, htnos, hashes, euc_low, euc_high):
+        buckets = defaultdict(set)
+        for htno, hash_bucket in zip(htnos.tolist(), hashes.tolist()):
+            buckets[htno].add(hash_bucket)
+
+        # one (htno, hash_bucket IN ..., euc_bucket BETWEEN ...) lookup per hash table;
+        # every (htno, hash_bucket) is a single range scan of the primary key
+        bucket_filters = [
+            and_(
+                IndexV2.htno == htno,
+                IndexV2.hash_bucket.in_(sorted(hash_buckets)),
+                IndexV2.euc_bucket.between(euc_low, euc_high),
+            )
+            for htno, hash_buckets in buckets.items()
+        ]
+
+        potential_matches = (
+            session.query(FaceIds.vec_id)
+            .join(IndexV2, IndexV2.face_id == FaceIds.face_id)
+            .filter(or_(*bucket_filters))
+            .distinct()
+            .all()
+        )
+
+        return sorted(x[0] for x in potential_matches)
+
+    def get_probe_buckets(self, arr, probes=None):
+        """returns the buckets to look up for the given encoding vector as two arrays
+        (htnos, hashes): the bucket of every hash table followed by the `probes`
+        perturbed buckets with the smallest margins (see probe_sequence)
+        """
+        return self._probe_buckets(np.matmul(arr, self.projection), probes)
+
+    def _probe_buckets(self, projected, probes=None):
+        if probes is None:
+            probes = NUM_PROBES
+
+        hashes = pack_hash_bits(np.expand_dims(projected, axis=0), self.hash_size)[0]
+        htnos = np.arange(len(hashes))
+
+        if probes <= 0:
+            return htnos, hashes
+
+        margins = np.abs(projected).reshape(len(hashes), self.hash_size)
+        perturbations = probe_sequence(margins, probes)
+
+        probe_htnos = np.array([htno for htno, _ in perturbations], dtype=np.int64)
+        probe_masks = np.array([mask for _, mask in perturbations], dtype=np.int64)
+
+        return (
+            np.concatenate([htnos, probe_htnos]),
+            np.concatenate([hashes, hashes[probe_htnos] ^ probe_masks]),
+        )
+
     def get_hash(self, arr):
         """Compute the hash value of the given matrix (each row is an embedding vector)
         with each hash table
@@ -370,19 +941,7 @@ class SQLDiskLSH:
         if dim == 1:
             arr = np.expand_dims(arr, axis=0)
 
-        hashes = [[] for _ in range(arr.shape[0])]
-
-        for hash_table in self.hash_tables:
-            hash_mat = np.matmul(arr, hash_table)
-
-            for row_num, row in enumerate(hash_mat):
-                bit_hash = []
-                for num in row:
-                    if num > 0:
-                        bit_hash.append("1")
-                    else:
-                        bit_hash.append("0")
-                hashes[row_num].append(int("".join(bit_hash), 2))
+        hashes = pack_hash_bits(np.matmul(arr, self.projection), self.hash_size)
 
         if dim == 1:
             return np.squeeze(hashes, axis=0)
@@ -418,41 +977,72 @@ class SQLDiskLSH:
 
         return similar
 
-    def _get_hash_tables(self):
-        with SessionCM() as session:
-            results = session.query(HashTables).all()
+    def _get_hash_tables(self, num_tables, hash_size, embedding_size, seed=None):
+        """loads the hash tables from the index database with a single read
 
-        # if the index database already contains hashtables
-        # then just return them
-        if results:
-            hash_tables = [
-                np.zeros(shape=(EMBEDDING_SIZE, HASH_SIZE)) for _ in range(NUM_TABLES)
-            ]
-
-            for res in results:
-                htno = res.htno
-                i = res.i
-                j = res.j
-                val = res.val
+        the first time, the hash tables are either converted from the (old) htables
+        table which stores one row per coefficient, or generated randomly,
+        and then stored as a single blob
+        """
+        with self.session_cm() as session:
+            blob = (
+                session.query(HashTablesBlob)
+                .filter(HashTablesBlob.name == "hash_tables")
+                .first()
+            )
+            if blob:
+                return list(self._blob_to_hash_tables(blob))
+
+            results = session.query(
+                HashTables.htno, HashTables.i, HashTables.j, HashTables.val
+            ).all()
+
+            # if the index database contains hashtables in the old format,
+            # then convert them
+            if results:
+                results = np.array(results)
+                htno, i, j = results[:, :3].astype(np.int64).T
+
+                hash_tables = np.zeros(shape=(htno.max() + 1, i.max() + 1, j.max() + 1))
+                hash_tables[htno, i, j] = results[:, 3]
+
+            # if the index database doesn't contain hashtables,
+            # then generate the hashtables
+            else:
+                hash_tables = np.random.default_rng(seed).standard_normal(
+                    (num_tables, embedding_size, hash_size)
+                )
 
-                hash_tables[htno][i][j] = val
+            try:
+                session.add(self._hash_tables_to_blob(hash_tables))
+                session.commit()
+            except IntegrityError:
+                # another process stored its hash tables first; use those
+                session.rollback()
+                blob = (
+                    session.query(HashTablesBlob)
+                    .filter(HashTablesBlob.name == "hash_tables")
+                    .first()
+                )
+                hash_tables = self._blob_to_hash_tables(blob)
 
-            return hash_tables
+        return list(hash_tables)
 
-        # if the index database doesn't contain hashtables,
-        # then generate the hashtables, store them in db and return them
-        else:
-            hash_tables = [
-                np.random.randn(EMBEDDING_SIZE, HASH_SIZE) for _ in range(NUM_TABLES)
-            ]
+    def _hash_tables_to_blob(self, hash_tables):
+        hash_tables = np.ascontiguousarray(hash_tables, dtype="<f8")
+        data = hash_tables.tobytes()
 
-            with SessionCM() as session:
-                for htno, htable in enumerate(hash_tables):
-                    for i in range(htable.shape[0]):
-                        for j in range(htable.shape[1]):
-                            val = hash_tables[htno][i][j]
-                            db_row = HashTables(htno, i, j, val)
+        return HashTablesBlob(
+            name="hash_tables",
+            shape=",".join(map(str, hash_tables.shape)),
+            dtype=hash_tables.dtype.str,
+            checksum=hashlib.sha256(data).hexdigest(),
+            data=data,
+        )
 
-                            commit_add_db_row(session, db_row)
+    def _blob_to_hash_tables(self, blob):
+        if hashlib.sha256(blob.data).hexdigest() != blob.checksum:
+            raise CorruptHashTables("checksum mismatch of the stored hash tables")
 
-            return hash_tables
+        shape = tuple(int(x) for x in blob.shape.split(","))
+        return np.frombuffer(blob.data, dtype=blob.dtype).reshape(shape)
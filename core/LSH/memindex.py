@@ -0,0 +1,249 @@
+"""
+In-memory (read-only) copy of the findex table for fast candidate generation
+
+Every (hash bucket, euclidean bucket) pair is packed into a single int64 key
+(for a table aware index, the hash bucket itself is (htno << hash_size) | bucket code)
+and the ids of each key are stored CSR style:
+
+    keys     -> sorted unique bucket keys
+    offsets  -> postings[offsets[i] : offsets[i + 1]] are the rows of keys[i]
+    postings -> int32 row numbers into ids
+    ids      -> sorted vec_ids
+
+so that looking up the candidates of a query is a handful of binary searches
+and array slices. The index is a snapshot: faces added to findex after it was
+built are only visible once it is rebuilt (or its snapshot is reloaded).
+
+usage (build a snapshot from the findex or findex_v2 table):
+    python -m core.LSH.memindex --snapshot-dir ./index_snapshot
+"""
+import pathlib
+import argparse
+import functools
+
+import numpy as np
+
+from .models import Index, IndexV2, FaceIds
+from .utils import SessionCM
+from ..utils import chunks
+
+# number of low bits of a bucket key that hold the euclidean bucket
+EUC_BITS = 16
+
+
+def euclidean_key(euc_bucket):
+    """converts an euclidean bucket string (Eg: "0d9") into an integer key (Eg: 9)"""
+    return int(round(float(euc_bucket.replace("d", ".")) * 10))
+
+
+def euclidean_bucket(euc_key):
+    """converts an integer key (Eg: 9) back into an euclidean bucket string (Eg: "0d9")"""
+    return str(round(euc_key / 10, 1)).replace(".", "d")
+
+
+def table_buckets(htnos, hashes, hash_size):
+    """combines the bucket codes (hashes) with the number of the hash table that
+    produced them (htnos), so that buckets of different tables don't collide
+    """
+    htnos = np.asarray(htnos, dtype=np.int64)
+    hashes = np.asarray(hashes, dtype=np.int64)
+    return (htnos << hash_size) | hashes
+
+
+def bucket_keys(hash_buckets, euc_keys):
+    """packs the hash buckets and euclidean keys (arrays of the same length) into int64 keys"""
+    hash_buckets = np.asarray(hash_buckets, dtype=np.int64)
+    euc_keys = np.asarray(euc_keys, dtype=np.int64)
+    return (hash_buckets << EUC_BITS) | euc_keys
+
+
+def concatenate(arrays, dtype):
+    """np.concatenate that also accepts an empty list of arrays"""
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+class MemoryBucketIndex:
+    def __init__(self, keys, offsets, postings, ids, table_aware=False):
+        self.keys = keys
+        self.offsets = offsets
+        self.postings = postings
+        self.ids = ids
+        self.table_aware = table_aware
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows, hash_buckets, euc_keys, ids, table_aware=False):
+        """builds the index from the columns of the index rows where
+        rows[i] is the position of the id of the i-th index row in ids (sorted)
+        """
+        keys = bucket_keys(hash_buckets, euc_keys)
+        return cls.from_keys(rows, keys, ids, table_aware)
+
+    @classmethod
+    def from_keys(cls, rows, keys, ids, table_aware=False):
+        """from_rows with the bucket keys of the index rows (see bucket_keys)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.int64)
+
+        order = np.lexsort((rows, keys))
+        keys, rows = keys[order], rows[order]
+
+        unique_keys, starts = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+
+        return cls(unique_keys, offsets, rows.astype(np.int32), ids, table_aware)
+
+    @classmethod
+    def from_db(cls, session, chunk_size=100000):
+        """builds the index by streaming the whole findex table (chunk_size rows
+        at a time, which are converted into arrays)
+        """
+        # position of every vec_id in the order of their first row
+        positions = {}
+        # there are only a few distinct euclidean buckets
+        to_euc_key = functools.lru_cache(maxsize=None)(euclidean_key)
+        rows, keys = [], []
+
+        results = session.query(
+            Index.vec_id, Index.hash_bucket, Index.euc_bucket
+        ).yield_per(chunk_size)
+
+        for chunk in chunks(results, chunk_size):
+            rows.append(
+                np.fromiter(
+                    (positions.setdefault(row[0], len(positions)) for row in chunk),
+                    dtype=np.int32,
+                    count=len(chunk),
+                )
+            )
+            hash_buckets = np.fromiter(
+                (int(row[1]) for row in chunk), dtype=np.int64, count=len(chunk)
+            )
+            euc_keys = np.fromiter(
+                (to_euc_key(row[2]) for row in chunk), dtype=np.int64, count=len(chunk)
+            )
+            keys.append(bucket_keys(hash_buckets, euc_keys))
+
+        # ids are sorted; renumber the rows accordingly
+        ids = np.asarray(list(positions), dtype=str)
+        order = np.argsort(ids)
+        ranks = np.empty(len(ids), dtype=np.int32)
+        ranks[order] = np.arange(len(ids), dtype=np.int32)
+
+        return cls.from_keys(
+            ranks[concatenate(rows, np.int32)], concatenate(keys, np.int64), ids[order]
+        )
+
+    @classmethod
+    def from_db_v2(cls, session, hash_size, chunk_size=100000):
+        """builds a table aware index by streaming the whole findex_v2 table
+        (chunk_size rows at a time, which are converted into arrays)
+        """
+        face_ids, vec_ids = [], []
+        results = session.query(FaceIds.face_id, FaceIds.vec_id).yield_per(chunk_size)
+        for chunk in chunks(results, chunk_size):
+            face_id_chunk, vec_id_chunk = zip(*chunk)
+            face_ids.append(np.asarray(face_id_chunk, dtype=np.int64))
+            vec_ids.append(np.asarray(vec_id_chunk, dtype=str))
+
+        row_face_ids, keys = [], []
+        results = session.query(
+            IndexV2.htno, IndexV2.hash_bucket, IndexV2.euc_bucket, IndexV2.face_id
+        ).yield_per(chunk_size)
+        for chunk in chunks(results, chunk_size):
+            htnos, hash_buckets, euc_keys, chunk_face_ids = np.array(
+                chunk, dtype=np.int64
+            ).T
+            row_face_ids.append(chunk_face_ids)
+            keys.append(
+                bucket_keys(table_buckets(htnos, hash_buckets, hash_size), euc_keys)
+            )
+
+        # ids are sorted by vec_id; map every face_id to the position of its vec_id
+        face_ids = concatenate(face_ids, np.int64)
+        vec_ids = concatenate(vec_ids, str)
+        order = np.argsort(vec_ids)
+        ids, face_ids = vec_ids[order], face_ids[order]
+
+        by_face_id = np.argsort(face_ids)
+        rows = by_face_id[
+            np.searchsorted(face_ids[by_face_id], concatenate(row_face_ids, np.int64))
+        ]
+
+        return cls.from_keys(rows, concatenate(keys, np.int64), ids, table_aware=True)
+
+    @classmethod
+    def load(cls, snapshot_dir, mmap_mode=None):
+        """loads a snapshot saved with save(); with mmap_mode="r" the arrays are
+        memory-mapped instead of being read into memory
+        """
+        snapshot_dir = pathlib.Path(snapshot_dir)
+        arrays = [
+            np.load(snapshot_dir / "{}.npy".format(name), mmap_mode=mmap_mode)
+            for name in ("keys", "offsets", "postings", "ids")
+        ]
+
+        table_aware = False
+        if (snapshot_dir / "table_aware.npy").exists():
+            table_aware = bool(np.load(snapshot_dir / "table_aware.npy"))
+
+        return cls(*arrays, table_aware=table_aware)
+
+    def save(self, snapshot_dir):
+        snapshot_dir = pathlib.Path(snapshot_dir)
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+
+        np.save(snapshot_dir / "keys.npy", self.keys)
+        np.save(snapshot_dir / "offsets.npy", self.offsets)
+        np.save(snapshot_dir / "postings.npy", self.postings)
+        np.save(snapshot_dir / "ids.npy", self.ids)
+        np.save(snapshot_dir / "table_aware.npy", np.array(self.table_aware))
+
+    def get_local_ids(self, hash_buckets, euc_low, euc_high):
+        """returns the sorted ids that are present in any of the given hash buckets
+        with an euclidean key in [euc_low, euc_high] (for a table aware index the
+        hash buckets must be combined with their table numbers, see table_buckets)
+
+        the keys of a hash bucket are sorted by euclidean key, so every hash bucket
+        is a single contiguous range of keys (and of postings)
+        """
+        hash_buckets = np.unique(np.asarray(hash_buckets, dtype=np.int64))
+        euc_low = max(euc_low, 0)
+
+        starts = np.searchsorted(self.keys, bucket_keys(hash_buckets, euc_low), "left")
+        ends = np.searchsorted(self.keys, bucket_keys(hash_buckets, euc_high), "right")
+
+        rows = [
+            self.postings[self.offsets[start] : self.offsets[end]]
+            for start, end in zip(starts, ends)
+            if end > start
+        ]
+        if not rows:
+            return []
+
+        return self.ids[np.unique(np.concatenate(rows))].tolist()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument(
+        "--snapshot-dir",
+        type=str,
+        default="./index_snapshot",
+        help="directory in which the snapshot of the in-memory index is saved",
+    )
+    args = ap.parse_args()
+
+    from .lsh import SQLDiskLSH
+
+    lsh = SQLDiskLSH()
+    with SessionCM() as session:
+        lsh.load_memory_index(session=session)
+
+    index = lsh.memory_index
+    index.save(args.snapshot_dir)
+    print("saved {} ids to {}".format(len(index), args.snapshot_dir))
@@ -0,0 +1,123 @@
+"""
+Online migration of the findex table (text columns, not table aware)
+to the findex_v2 table (integer columns, table aware)
+
+findex doesn't record which hash table produced a bucket, so every face is
+re-hashed from its embedding (with the same hash tables) instead of being copied.
+While the migration runs, queries keep using findex and SQLDiskLSH.add_many writes
+new faces to both tables. Once every face is copied, the schema version is switched
+to SCHEMA_V2 and all the processes start using findex_v2.
+
+The migration commits after every batch and remembers its position, so it can be
+interrupted and resumed at any time.
+
+usage: python -m core.LSH.migrate_findex [--batch-size 1000] [--embedding-store DIR] [--drop-findex]
+"""
+import argparse
+
+import numpy as np
+from sqlalchemy import distinct
+
+from .lsh import SQLDiskLSH, SCHEMA_V1, SCHEMA_MIGRATING, SCHEMA_V2
+from .models import Index, Meta
+from .utils import SessionCM, map_embeddings
+from .config import EMBEDDING_SIZE
+
+CURSOR_KEY = "findex_migration_cursor"
+
+
+def migrate_findex(session, lsh, mapper, batch_size=1000):
+    """copies every face of findex to findex_v2 (batch_size faces per transaction)
+
+    Returns: number of faces that were migrated
+    """
+    schema_version = lsh.get_schema_version(session)
+    if schema_version == SCHEMA_V2:
+        print("findex is already migrated")
+        return 0
+
+    if schema_version == SCHEMA_V1:
+        lsh.set_schema_version(session, SCHEMA_MIGRATING)
+
+    cursor = session.query(Meta).filter(Meta.key == CURSOR_KEY).first()
+    last_vec_id = cursor.value if cursor else ""
+
+    num_faces = 0
+    while True:
+        vec_ids = (
+            session.query(distinct(Index.vec_id))
+            .filter(Index.vec_id > last_vec_id)
+            .order_by(Index.vec_id)
+            .limit(batch_size)
+            .all()
+        )
+        vec_ids = [x[0] for x in vec_ids]
+        if not vec_ids:
+            break
+
+        embeddings = map_embeddings(mapper, vec_ids)
+        found = ~np.isnan(embeddings).any(axis=1)
+        if not found.all():
+            print("* no embedding found for {} faces".format(np.sum(~found)))
+
+        found_ids = [vec_id for vec_id, f in zip(vec_ids, found) if f]
+        if found_ids:
+            embeddings = embeddings[found]
+            lsh._add_v2_rows(
+                session,
+                found_ids,
+                lsh.get_hash(embeddings),
+                [lsh.get_euclidean_index(row) for row in embeddings],
+                chunk_size=5000,
+            )
+
+        last_vec_id = vec_ids[-1]
+        session.merge(Meta(CURSOR_KEY, last_vec_id))
+        session.commit()
+
+        num_faces += len(found_ids)
+        print("migrated {} faces".format(num_faces))
+
+    lsh.set_schema_version(session, SCHEMA_V2)
+    return num_faces
+
+
+if __name__ == "__main__":
+    from ..mappers import default_sql_batch_mapper
+    from ..FaceData.store import EmbeddingStore
+
+    ap = argparse.ArgumentParser(allow_abbrev=False)
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of faces migrated per transaction",
+    )
+    ap.add_argument(
+        "--embedding-store",
+        type=str,
+        default=None,
+        help="read the embeddings from this embedding store instead of the FaceData database",
+    )
+    ap.add_argument(
+        "--drop-findex",
+        action="store_true",
+        help="delete the rows of the old findex table once the migration is complete",
+    )
+    args = ap.parse_args()
+
+    mapper = default_sql_batch_mapper
+    if args.embedding_store:
+        mapper = EmbeddingStore(
+            args.embedding_store,
+            embedding_size=EMBEDDING_SIZE,
+            fallback=default_sql_batch_mapper,
+        )
+
+    lsh = SQLDiskLSH()
+    with SessionCM() as session:
+        migrate_findex(session, lsh, mapper, batch_size=args.batch_size)
+
+        if args.drop_findex:
+            session.query(Index).delete(synchronize_session=False)
+            session.commit()
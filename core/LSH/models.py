@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Text, Integer, Float
-from sqlalchemy.schema import PrimaryKeyConstraint
+from sqlalchemy import Column, Text, String, Integer, BigInteger, Float, LargeBinary
+from sqlalchemy.schema import PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy.schema import Index as SQLIndex
 
 from .base import Base
 
@@ -27,6 +28,100 @@ class Index(Base, AutoRepr):
         self.euc_bucket = euc_bucket
 
 
+class FaceIds(Base, AutoRepr):
+    """integer surrogate ids of the indexed faces"""
+
+    __tablename__ = "fids"
+
+    face_id = Column(Integer, primary_key=True, autoincrement=True)
+    vec_id = Column(String(255), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(vec_id),
+        {},
+    )
+
+    def __init__(self, vec_id):
+        self.vec_id = vec_id
+
+
+class IndexV2(Base, AutoRepr):
+    """
+    Table aware version of the findex table where every column is an integer
+
+    htno: number of the hash table that produced the bucket
+    hash_bucket: the bucket code
+    euc_bucket: the euclidean bucket; round(||x||, 1) * 10
+    face_id: FaceIds.face_id
+
+    The primary key (htno, hash_bucket, euc_bucket, face_id) is the clustered index,
+    so the bucket lookups of get_local_ids are covered by it
+    """
+
+    __tablename__ = "findex_v2"
+
+    htno = Column(Integer, autoincrement=False)
+    hash_bucket = Column(Integer, autoincrement=False)
+    euc_bucket = Column(Integer, autoincrement=False)
+    face_id = Column(Integer, autoincrement=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(htno, hash_bucket, euc_bucket, face_id),
+        SQLIndex("ix_findex_v2_face_id", face_id),
+        {"sqlite_with_rowid": False},
+    )
+
+    def __init__(self, htno, hash_bucket, euc_bucket, face_id):
+        self.htno = htno
+        self.hash_bucket = hash_bucket
+        self.euc_bucket = euc_bucket
+        self.face_id = face_id
+
+
+class BucketUpdates(Base, AutoRepr):
+    """
+    Time of the last addition of a face to every bucket (used to invalidate the
+    cached query results that depend on the bucket, see core/resultcache.py)
+
+    bucket_key: the (htno, hash_bucket, euc_bucket) of the face packed into a single
+        integer; memindex.bucket_keys(memindex.table_buckets(htno, hash_bucket), euc_bucket)
+    updated_at: unix time of the last addition
+    """
+
+    __tablename__ = "bucket_updates"
+
+    bucket_key = Column(BigInteger, autoincrement=False)
+    updated_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(bucket_key),
+        SQLIndex("ix_bucket_updates_updated_at", updated_at),
+        {},
+    )
+
+    def __init__(self, bucket_key, updated_at):
+        self.bucket_key = bucket_key
+        self.updated_at = updated_at
+
+
+class Meta(Base, AutoRepr):
+    """key value store for the state of the index database (Eg: schema version)"""
+
+    __tablename__ = "lsh_meta"
+
+    key = Column(String(64))
+    value = Column(Text)
+
+    __table_args__ = (
+        PrimaryKeyConstraint(key),
+        {},
+    )
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
 class HashTables(Base, AutoRepr):
     __tablename__ = "htables"
 
@@ -45,3 +140,34 @@ class HashTables(Base, AutoRepr):
         self.i = i
         self.j = j
         self.val = val
+
+
+class HashTablesBlob(Base, AutoRepr):
+    """
+    all the hash tables stored as a single (num_tables, embedding_size, hash_size) array
+
+    data: raw bytes of the array (C order)
+    shape: comma separated shape of the array; Eg: "49,128,7"
+    dtype: numpy dtype string of the array; Eg: "<f8"
+    checksum: sha256 hex digest of data
+    """
+
+    __tablename__ = "htables_blob"
+
+    name = Column(String(64))
+    shape = Column(Text)
+    dtype = Column(Text)
+    checksum = Column(Text)
+    data = Column(LargeBinary(length=2 ** 24))
+
+    __table_args__ = (
+        PrimaryKeyConstraint(name),
+        {},
+    )
+
+    def __init__(self, name, shape, dtype, checksum, data):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.checksum = checksum
+        self.data = data
@@ -1,3 +1,4 @@
+import numpy as np
 from sqlalchemy.exc import IntegrityError
 from .base import Session
 
@@ -26,3 +27,32 @@ def commit_add_db_row(session, db_row):
         session.commit()
         print("* SUCESS")
         return 1
+
+
+def batch_mapper(mapper):
+    """Decorator that marks a mapper as a batch mapper
+
+    A batch mapper takes a list of ids and returns a matrix where the i-th row
+    is the encoding vector of ids[i] (rows of unknown ids are filled with nan).
+    A regular mapper takes a single id and returns a single encoding vector
+    """
+    mapper.is_batch_mapper = True
+    return mapper
+
+
+def map_embeddings(mapper, ids):
+    """returns the encoding vectors of the given ids as a matrix
+    using either a batch mapper or a regular (one id at a time) mapper
+    """
+    if getattr(mapper, "is_batch_mapper", False):
+        return np.asarray(mapper(ids), dtype=np.float64)
+
+    encodings = [np.asarray(mapper(id), dtype=np.float64) for id in ids]
+    embedding_size = max(len(encoding) for encoding in encodings)
+
+    matrix = np.full((len(ids), embedding_size), np.nan)
+    for row_num, encoding in enumerate(encodings):
+        if len(encoding) == embedding_size:
+            matrix[row_num] = encoding
+
+    return matrix
@@ -0,0 +1,279 @@
+"""
+Content addressed cache of the faces detected in an image
+
+The key of an image is the sha256 of its (encoded) bytes combined with the options
+that change the detected faces (model, upsample, num_jitters, downscale), and the
+value is the list of (face_num, face_loc, face_embedding) returned by get_faces.
+
+    - memory tier: the max_items most recently used images (LRU)
+    - disk tier (optional): one npz file per image in cache_dir, shared by every
+      process that uses the same cache_dir (Eg: the workers of the server and the
+      detection processes of the ingest pipeline); when max_disk_bytes is given,
+      the least recently used files are deleted once the tier grows beyond it
+
+A cache can be passed to other processes. It is pickled without its memory tier;
+all the copies of a cache that are unpickled in the same process share one memory
+tier (Eg: the tasks that a detection process of the pipeline receives).
+"""
+import os
+import uuid
+import pathlib
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .LSH.config import EMBEDDING_SIZE
+
+# counters of the stats (see FaceCache.take_counters)
+COUNTERS = ("memory_hits", "disk_hits", "misses", "evictions", "disk_evictions")
+
+# the files of the disk tier are pruned down to this fraction of max_disk_bytes
+PRUNE_RATIO = 0.9
+# the size of the disk tier is measured again every PRUNE_CHECK_INTERVAL saves
+# (it also grows with the files saved by the other processes)
+PRUNE_CHECK_INTERVAL = 1000
+
+# memory tiers of the caches unpickled in this process, by cache id
+_MEMORY_TIERS = {}
+_MEMORY_TIERS_LOCK = threading.Lock()
+
+
+def image_key(image_bytes, model="hog", upsample=1, num_jitters=1, downscale=1):
+    """cache key of the encoded image with the given get_faces options"""
+    return "{}-{}-{}-{}-{}".format(
+        hashlib.sha256(image_bytes).hexdigest(), model, upsample, num_jitters, downscale
+    )
+
+
+class FaceCache:
+    """
+    Args:
+        cache_dir: directory of the disk tier (None keeps the faces only in memory)
+        max_items: number of images kept in the memory tier
+        max_disk_bytes: (optional) size above which the least recently used files
+            of the disk tier are deleted
+    """
+
+    def __init__(self, cache_dir=None, max_items=1024, max_disk_bytes=None):
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else None
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_id = uuid.uuid4().hex
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._init_memory()
+
+    def _init_memory(self):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(COUNTERS, 0)
+        # size of the disk tier (None until it is measured) and saves since then
+        self._disk = {"bytes": None, "saves": 0}
+
+    def __getstate__(self):
+        return {
+            "cache_dir": self.cache_dir,
+            "max_items": self.max_items,
+            "max_disk_bytes": self.max_disk_bytes,
+            "cache_id": self.cache_id,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        with _MEMORY_TIERS_LOCK:
+            memory = _MEMORY_TIERS.get(self.cache_id)
+            if memory is None:
+                self._init_memory()
+                _MEMORY_TIERS[self.cache_id] = (
+                    self._items,
+                    self._lock,
+                    self._stats,
+                    self._disk,
+                )
+            else:
+                self._items, self._lock, self._stats, self._disk = memory
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """returns the cached faces of the key (None if they aren't cached)"""
+        with self._lock:
+            faces = self._items.get(key)
+            if faces is not None:
+                self._items.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return faces
+
+        faces = self._load(key)
+
+        with self._lock:
+            if faces is None:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["disk_hits"] += 1
+            self._remember(key, faces)
+            return faces
+
+    def put(self, key, faces):
+        faces = [
+            (face_num, tuple(face_loc), list(face_embedding))
+            for face_num, face_loc, face_embedding in faces
+        ]
+
+        with self._lock:
+            self._remember(key, faces)
+
+        self._save(key, faces)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_items"] = len(self._items)
+            stats["disk_bytes"] = self._disk["bytes"]
+
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else None
+        )
+        return stats
+
+    def take_counters(self):
+        """returns the counters (COUNTERS) and resets them; Eg: a worker process
+        passes the counters of its copy of the cache to the parent (see add_counters)
+        """
+        with self._lock:
+            counters = {name: self._stats[name] for name in COUNTERS}
+            self._stats.update(dict.fromkeys(COUNTERS, 0))
+            return counters
+
+    def add_counters(self, counters):
+        """adds the counters taken from a copy of the cache in another process"""
+        with self._lock:
+            for name in COUNTERS:
+                self._stats[name] += counters.get(name, 0)
+
+    def _remember(self, key, faces):
+        self._items[key] = faces
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / "{}.npz".format(key)
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                face_locs = data["face_locs"].tolist()
+                face_embeddings = data["face_embeddings"].tolist()
+        except (OSError, ValueError, KeyError):
+            # not cached (or a corrupt file, which is overwritten by the next put)
+            return None
+
+        if self.max_disk_bytes is not None:
+            # the modification time orders the files for the pruning (LRU)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+        return [
+            (face_num, tuple(face_loc), face_embedding)
+            for face_num, (face_loc, face_embedding) in enumerate(
+                zip(face_locs, face_embeddings)
+            )
+        ]
+
+    def _save(self, key, faces):
+        if self.cache_dir is None:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        face_locs = np.array([face_loc for _, face_loc, _ in faces], dtype=np.int64)
+        face_embeddings = np.array(
+            [face_embedding for _, _, face_embedding in faces], dtype=np.float64
+        )
+
+        # written to a temporary file first, so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    face_locs=face_locs.reshape(len(faces), 4),
+                    face_embeddings=face_embeddings.reshape(len(faces), EMBEDDING_SIZE),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self.max_disk_bytes is not None:
+            self._check_disk_size(os.path.getsize(path))
+
+    def _check_disk_size(self, saved_bytes):
+        with self._lock:
+            self._disk["saves"] += 1
+            if self._disk["bytes"] is not None:
+                self._disk["bytes"] += saved_bytes
+
+            if (
+                self._disk["bytes"] is not None
+                and self._disk["bytes"] <= self.max_disk_bytes
+                and self._disk["saves"] < PRUNE_CHECK_INTERVAL
+            ):
+                return
+            self._disk["saves"] = 0
+
+        disk_bytes, num_deleted = self._prune()
+
+        with self._lock:
+            self._disk["bytes"] = disk_bytes
+            self._stats["disk_evictions"] += num_deleted
+
+    def _prune(self):
+        """deletes the least recently used files of the disk tier until it holds
+        at most PRUNE_RATIO * max_disk_bytes
+
+        Returns: (size of the disk tier, number of deleted files)
+        """
+        files = []
+        for path in self.cache_dir.glob("*/*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        disk_bytes = sum(size for _, size, _ in files)
+        if disk_bytes <= self.max_disk_bytes:
+            return disk_bytes, 0
+
+        num_deleted = 0
+        for _, size, path in sorted(files):
+            if disk_bytes <= PRUNE_RATIO * self.max_disk_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            disk_bytes -= size
+            num_deleted += 1
+
+        return disk_bytes, num_deleted
@@ -1,12 +1,23 @@
+import io
+import time
+import functools
+import numpy as np
 import face_recognition
+from PIL import Image
+from collections import defaultdict
 
 from .scraper import scrape_url
-from .FaceData.add_face import add_data
-from .FaceData.models import FData, FLoc
+from .FaceData.add_face import add_many_data, update_scrape_state
+from .FaceData.models import FData, FBox, FLoc
 from .FaceData.utils import SessionCM as FaceDataSessionCM
 from .LSH.utils import SessionCM as FaceIndexSessionCM
+from .FaceData.store import EmbeddingStore, iter_embedding_batches
 from .LSH.lsh import SQLDiskLSH, NonEmptyDirectory
+from .LSH.exact import ExactIndex
+from .LSH.ivfpq import IVFPQIndex
+from .LSH.config import EMBEDDING_SIZE, INDEX_TYPE, IVFPQ_INDEX_FILE
 from .utils import pil_compatible_bb
+from .facecache import FaceCache, image_key
 from .mappers import default_sql_mapper
 
 import argparse
@@ -25,76 +36,431 @@ def set_credentials(domain, username, password):
         f.write("password = '{}' \n".format(password))
 
 
-def get_faces(img_path):
-    image = face_recognition.load_image_file(img_path)
+def make_index(index_type=INDEX_TYPE, store=None):
+    """creates the index selected by index_type
 
-    face_locations = face_recognition.face_locations(image)
-    if not face_locations:
-        return
+    "lsh": SQLDiskLSH (approximate; candidates from the index database)
+    "exact": ExactIndex (brute force over all the embeddings); loaded from the
+        embedding store if one is given, otherwise from the FaceData database
+    "ivfpq": IVFPQIndex (compressed); loaded from IVFPQ_INDEX_FILE, which is
+        created with `python -m core.LSH.ivfpq`
+    """
+    if index_type == "lsh":
+        return SQLDiskLSH()
+
+    if index_type == "exact":
+        if store is not None:
+            return ExactIndex.from_matrix(store.ids, store.matrix)
+
+        index = ExactIndex(embedding_size=EMBEDDING_SIZE)
+        with FaceDataSessionCM() as session:
+            for ids, matrix in iter_embedding_batches(session):
+                index.add_many(session, ids, matrix)
+        return index
+
+    if index_type == "ivfpq":
+        return IVFPQIndex.load(IVFPQ_INDEX_FILE)
+
+    raise ValueError("Unknown index type {}".format(index_type))
+
+
+def load_image(image):
+    """decodes the image (path of an image file, file-like object or the encoded
+    image as bytes) into an RGB numpy array
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+
+    return face_recognition.load_image_file(image)
 
-    face_embeddings = face_recognition.face_encodings(image)
 
-    corrected_face_locations = []
-    for coords in face_locations:
-        corrected_face_locations.append(pil_compatible_bb(coords))
+def downscale_image(image, downscale):
+    """shrinks the image by the downscale factor (1 keeps the image as it is)"""
+    if downscale <= 1:
+        return image
+
+    height, width = image.shape[:2]
+    size = (max(1, round(width / downscale)), max(1, round(height / downscale)))
+    return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR))
+
+
+def upscale_locations(face_locations, small_shape, shape):
+    """maps the (top, right, bottom, left) face locations detected in the downscaled
+    image (of shape small_shape) back to the coordinates of the original image
+    """
+    if small_shape[:2] == shape[:2]:
+        return face_locations
+
+    scale_y = shape[0] / small_shape[0]
+    scale_x = shape[1] / small_shape[1]
+
+    return [
+        (
+            max(0, int(round(top * scale_y))),
+            min(shape[1], int(round(right * scale_x))),
+            min(shape[0], int(round(bottom * scale_y))),
+            max(0, int(round(left * scale_x))),
+        )
+        for top, right, bottom, left in face_locations
+    ]
+
+
+def encode_faces(image, face_locations, num_jitters=1):
+    """returns (face_num, face_loc, face_embedding) for every one of the
+    (top, right, bottom, left) face locations of the image
+    """
+    face_embeddings = face_recognition.face_encodings(
+        image, known_face_locations=face_locations, num_jitters=num_jitters
+    )
 
-    for face_num, (face_loc, face_embedding) in enumerate(
-        zip(corrected_face_locations, face_embeddings)
+    faces = []
+    for face_num, (coords, face_embedding) in enumerate(
+        zip(face_locations, face_embeddings)
     ):
-        face_embedding = list(face_embedding)
+        faces.append((face_num, pil_compatible_bb(coords), list(face_embedding)))
 
-        yield (face_num, face_loc, face_embedding)
+    return faces
 
 
-def query(index, mapper, face_encoding, k=10):
-    with FaceIndexSessionCM() as session:
-        matching_id_dist = index.query(session, mapper, face_encoding, k=k)
+def read_image_bytes(image):
+    """returns the encoded bytes of the image (path, file-like object or bytes)"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
 
-    matches = []
-    with FaceDataSessionCM() as session:
-        for match in matching_id_dist:
-            post_data = session.query(FData).filter(FData.vec_id == match.l_id).all()
-            post_data = post_data[0]
-
-            loc_data = session.query(FLoc).filter(FLoc.vec_id == match.l_id).all()
-            loc_data = sorted(loc_data, key=lambda x: x.loc_idx)
-            loc_data = [l.loc_val for l in loc_data]
-
-            data = {
-                "id": post_data.vec_id,
-                "post_url": post_data.post_url,
-                "img_url": post_data.img_url,
-                "loc": loc_data,
+    if hasattr(image, "read"):
+        return image.read()
+
+    with open(image, "rb") as f:
+        return f.read()
+
+
+def get_faces(image, model="hog", upsample=1, num_jitters=1, downscale=1, cache=None):
+    """yields (face_num, face_loc, face_embedding) for every face of the image
+
+    image is the path of an image file, a file-like object or the encoded
+    image as bytes (which is decoded in memory)
+
+    Args:
+        model: face detection model; "hog" (faster on cpus) or "cnn" (more accurate,
+            faster on gpus)
+        upsample: number of times the image is upsampled to find smaller faces
+        num_jitters: number of times the faces are re-sampled when computing their
+            embeddings (higher is more accurate but slower)
+        downscale: the faces are detected in an image that is downscale times smaller
+            (the face locations and embeddings are still computed on the original image)
+        cache: (optional) FaceCache; the faces of images that were already
+            seen (same bytes and options) are not detected again
+    """
+    if cache is None:
+        faces = detect_faces(image, model, upsample, num_jitters, downscale)
+    else:
+        image = read_image_bytes(image)
+        key = image_key(image, model, upsample, num_jitters, downscale)
+
+        faces = cache.get(key)
+        if faces is None:
+            faces = detect_faces(image, model, upsample, num_jitters, downscale)
+            cache.put(key, faces)
+
+    for face_data in faces:
+        yield face_data
+
+
+def detect_faces(image, model="hog", upsample=1, num_jitters=1, downscale=1):
+    """returns the (face_num, face_loc, face_embedding) of every face of the image
+    (see get_faces)
+    """
+    image = load_image(image)
+
+    small_image = downscale_image(image, downscale)
+    face_locations = face_recognition.face_locations(
+        small_image, number_of_times_to_upsample=upsample, model=model
+    )
+    if not face_locations:
+        return []
+
+    face_locations = upscale_locations(face_locations, small_image.shape, image.shape)
+    return encode_faces(image, face_locations, num_jitters)
+
+
+def get_faces_batch(
+    images, upsample=1, num_jitters=1, downscale=1, batch_size=32, cache=None
+):
+    """get_faces for a list of images, using batched cnn face detection
+    (face_recognition.batch_face_locations), which is much faster on a gpu
+
+    images of the same size are detected together (batch_size images at a time)
+    and, when a cache is given, only the images that aren't cached are detected
+
+    Returns: list with the (face_num, face_loc, face_embedding) of every face of every image
+    """
+    if cache is None:
+        return detect_faces_batch(images, upsample, num_jitters, downscale, batch_size)
+
+    images = [read_image_bytes(image) for image in images]
+    keys = [
+        image_key(image, "cnn", upsample, num_jitters, downscale) for image in images
+    ]
+
+    faces = [cache.get(key) for key in keys]
+    missing = [image_num for image_num, f in enumerate(faces) if f is None]
+
+    detected = detect_faces_batch(
+        [images[image_num] for image_num in missing],
+        upsample,
+        num_jitters,
+        downscale,
+        batch_size,
+    )
+    for image_num, image_faces in zip(missing, detected):
+        cache.put(keys[image_num], image_faces)
+        faces[image_num] = image_faces
+
+    return faces
+
+
+def detect_faces_batch(images, upsample=1, num_jitters=1, downscale=1, batch_size=32):
+    """returns the faces of every image with batched cnn face detection (see get_faces_batch)"""
+    images = [load_image(image) for image in images]
+    small_images = [downscale_image(image, downscale) for image in images]
+
+    # batch_face_locations needs images of the same size
+    same_size = defaultdict(list)
+    for image_num, small_image in enumerate(small_images):
+        same_size[small_image.shape].append(image_num)
+
+    face_locations = [None] * len(images)
+    for image_nums in same_size.values():
+        batch_locations = face_recognition.batch_face_locations(
+            [small_images[image_num] for image_num in image_nums],
+            number_of_times_to_upsample=upsample,
+            batch_size=batch_size,
+        )
+        for image_num, locations in zip(image_nums, batch_locations):
+            face_locations[image_num] = locations
+
+    faces = []
+    for image, small_image, locations in zip(images, small_images, face_locations):
+        if not locations:
+            faces.append([])
+            continue
+
+        locations = upscale_locations(locations, small_image.shape, image.shape)
+        faces.append(encode_faces(image, locations, num_jitters))
+
+    return faces
+
+
+def get_match_data(session, matching_id_dist):
+    """fetches the post data and face location of every match (list of ENCDIST)"""
+    return get_match_data_many(session, [matching_id_dist])[0]
+
+
+def get_match_data_many(session, matching_id_dists, chunk_size=500):
+    """get_match_data for the matches of many faces
+
+    the data of all the matched ids is fetched with one fdata/fbox join
+    (per chunk_size ids), so the number of queries doesn't grow with k;
+    locations that are only stored as floc rows (not migrated yet, see
+    FaceData/migrate_locations.py) are fetched with one more query
+
+    Returns: list with the data of the matches of every face
+    """
+    ids = sorted(set(match.l_id for matches in matching_id_dists for match in matches))
+
+    post_data, locs = {}, {}
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start : start + chunk_size]
+        results = (
+            session.query(
+                FData.vec_id,
+                FData.post_url,
+                FData.img_url,
+                FBox.left,
+                FBox.top,
+                FBox.right,
+                FBox.bottom,
+            )
+            .outerjoin(FBox, FBox.vec_id == FData.vec_id)
+            .filter(FData.vec_id.in_(chunk))
+            .all()
+        )
+
+        for vec_id, post_url, img_url, *box in results:
+            post_data[vec_id] = (post_url, img_url)
+            if box[0] is not None:
+                locs[vec_id] = box
+
+    missing = [vec_id for vec_id in ids if vec_id in post_data and vec_id not in locs]
+    for start in range(0, len(missing), chunk_size):
+        results = (
+            session.query(FLoc.vec_id, FLoc.loc_val)
+            .filter(FLoc.vec_id.in_(missing[start : start + chunk_size]))
+            .order_by(FLoc.vec_id, FLoc.loc_idx)
+            .all()
+        )
+        for vec_id, loc_val in results:
+            locs.setdefault(vec_id, []).append(loc_val)
+
+    # matches without face data are skipped
+    return [
+        [
+            {
+                "id": match.l_id,
+                "post_url": post_data[match.l_id][0],
+                "img_url": post_data[match.l_id][1],
+                "loc": locs.get(match.l_id, []),
                 "dist": match.dist,
             }
+            for match in matches
+            if match.l_id in post_data
+        ]
+        for matches in matching_id_dists
+    ]
+
+
+def query(index, mapper, face_encoding, k=10, result_cache=None, **query_options):
+    """query_options are passed on to index.query (Eg: probes or euc_window for SQLDiskLSH)
+
+    result_cache: (optional) ResultCache consulted before searching the index
+    """
+    if result_cache is not None:
+        return query_many(
+            index,
+            mapper,
+            [face_encoding],
+            k=k,
+            result_cache=result_cache,
+            **query_options
+        )[0]
+
+    with FaceIndexSessionCM() as session:
+        matching_id_dist = index.query(
+            session, mapper, face_encoding, k=k, **query_options
+        )
+
+    with FaceDataSessionCM() as session:
+        return get_match_data(session, matching_id_dist)
+
+
+def query_many(
+    index, mapper, face_encodings, k=10, timings=None, result_cache=None, **query_options
+):
+    """query for a batch of face encodings (Eg: all the faces of a group photo)
+    using a single session of each database
+
+    indexes with a query_many method search all the encodings at once,
+    the others are queried one encoding at a time
+
+    timings: (optional) dict in which the seconds spent searching the index ("search")
+        and fetching the data of the matches ("hydrate") are recorded
+    result_cache: (optional) ResultCache; only the face encodings whose matches
+        aren't cached are searched (and their matches are cached). It is ignored
+        unless index.can_cache_results (Eg: an up to date SQLDiskLSH index)
+
+    Returns: list with the matches of every face encoding
+    """
+    matches = [None] * len(face_encodings)
+    keys = [None] * len(face_encodings)
 
-            matches.append(data)
+    start = time.perf_counter()
+    with FaceIndexSessionCM() as session:
+        if result_cache is not None and not (
+            hasattr(index, "can_cache_results") and index.can_cache_results(session)
+        ):
+            # the index doesn't report the buckets of the added faces, so the
+            # cached matches could never be invalidated
+            result_cache = None
+
+        if result_cache is not None:
+            # drop the cached matches that new faces could have changed
+            result_cache.refresh(functools.partial(index.get_bucket_updates, session))
+
+            for i, face_encoding in enumerate(face_encodings):
+                keys[i] = result_cache.key(face_encoding, k=k, **query_options)
+                matches[i] = result_cache.get(keys[i])
+
+        missing = [i for i, face_matches in enumerate(matches) if face_matches is None]
+        missing_encodings = [face_encodings[i] for i in missing]
+
+        if not missing:
+            matching_id_dists = []
+        elif hasattr(index, "query_many"):
+            matching_id_dists = index.query_many(
+                session, mapper, missing_encodings, k=k, **query_options
+            )
+        else:
+            matching_id_dists = [
+                index.query(session, mapper, face_encoding, k=k, **query_options)
+                for face_encoding in missing_encodings
+            ]
+
+    search_end = time.perf_counter()
+
+    with FaceDataSessionCM() as session:
+        for i, face_matches in zip(
+            missing, get_match_data_many(session, matching_id_dists)
+        ):
+            matches[i] = face_matches
+
+    if result_cache is not None:
+        for i in missing:
+            buckets = index.get_query_buckets(face_encodings[i], **query_options)
+            result_cache.put(keys[i], matches[i], buckets)
+
+    if timings is not None:
+        timings["search"] = search_end - start
+        timings["hydrate"] = time.perf_counter() - search_end
 
     return matches
 
 
-def add(index, url):
+def add(index, url, store=None, face_options=None):
+    """scrapes the url, stores the face data of every detected face and indexes it
+
+    store: (optional) EmbeddingStore to which the face embeddings are also appended
+    face_options: (optional) dict of get_faces options (model, upsample, num_jitters,
+        downscale, cache)
+    """
+    face_options = face_options or {}
+
     with FaceDataSessionCM() as fd_session, FaceIndexSessionCM() as fi_session:
         print("Scraping URL: ", url)
         for scraped_data in scrape_url(url):
-            img_id, post_url, img_url, saved_img_path = scraped_data
-            for face_data in get_faces(saved_img_path):
+            img_id, post_url, img_url, image = scraped_data
+
+            faces = []
+            for face_data in get_faces(image, **face_options):
                 if not face_data:
                     continue
 
                 face_num, face_loc, face_embedding = face_data
-                face_id = "{}_{}".format(img_id, face_num)
-
-                add_data(
-                    session=fd_session,
-                    vec_id=face_id,
-                    face_embedding=face_embedding,
-                    face_loc=face_loc,
-                    post_url=post_url,
-                    img_url=img_url,
+                faces.append(
+                    {
+                        "vec_id": "{}_{}".format(img_id, face_num),
+                        "face_embedding": face_embedding,
+                        "face_loc": face_loc,
+                        "post_url": post_url,
+                        "img_url": img_url,
+                    }
+                )
+
+            # the faces are indexed before their data and the scrape state of the
+            # image are committed (together), so that after a crash in between the
+            # image is scraped again instead of its faces never being indexed
+            if faces:
+                face_ids = [face["vec_id"] for face in faces]
+                face_embeddings = [face["face_embedding"] for face in faces]
+
+                index.add_many(
+                    session=fi_session, ids=face_ids, matrix=face_embeddings
                 )
 
-                index.add(session=fi_session, id=face_id, arr=face_embedding)
+                if store is not None:
+                    store.append(face_ids, face_embeddings)
+
+            update_scrape_state(fd_session, img_id, len(faces))
+            add_many_data(fd_session, faces)
 
 
 if __name__ == "__main__":
@@ -107,8 +473,134 @@ if __name__ == "__main__":
         required=True,
         help="list of profile urls to scrape (space separated)",
     )
+    ap.add_argument(
+        "--index",
+        type=str,
+        choices=["lsh", "exact", "ivfpq"],
+        default=INDEX_TYPE,
+        help="index to which the faces are added",
+    )
+    ap.add_argument(
+        "--embedding-store",
+        type=str,
+        default=None,
+        help="directory of an embedding store to which the face embeddings are also appended",
+    )
+    ap.add_argument(
+        "--parallel",
+        action="store_true",
+        help="download, detect and index the images with the parallel pipeline "
+        "(see core/pipeline.py) instead of one image at a time",
+    )
+    ap.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="number of threads downloading images",
+    )
+    ap.add_argument(
+        "--detect-workers",
+        type=int,
+        default=None,
+        help="number of processes detecting faces with --parallel (default: number of cpus)",
+    )
+    ap.add_argument(
+        "--model",
+        type=str,
+        choices=["hog", "cnn"],
+        default="hog",
+        help="face detection model",
+    )
+    ap.add_argument(
+        "--upsample",
+        type=int,
+        default=1,
+        help="number of times the images are upsampled to find smaller faces",
+    )
+    ap.add_argument(
+        "--num-jitters",
+        type=int,
+        default=1,
+        help="number of times the faces are re-sampled when computing their embeddings",
+    )
+    ap.add_argument(
+        "--downscale",
+        type=float,
+        default=1,
+        help="detect the faces in images that are downscale times smaller",
+    )
+    ap.add_argument(
+        "--face-cache-dir",
+        type=str,
+        default=None,
+        help="cache the faces detected in every image in this directory "
+        "(images that were already seen are not detected again)",
+    )
+    ap.add_argument(
+        "--face-cache-disk-mb",
+        type=int,
+        default=None,
+        help="size in MB above which the least recently used images of "
+        "--face-cache-dir are deleted (default: unbounded)",
+    )
+    ap.add_argument(
+        "--detect-batch-size",
+        type=int,
+        default=1,
+        help="number of images whose faces are detected together (needs --model cnn)",
+    )
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="number of faces written to the databases per transaction",
+    )
     args = ap.parse_args()
 
-    index = SQLDiskLSH()
+    if args.detect_batch_size > 1 and args.model != "cnn":
+        ap.error("--detect-batch-size needs --model cnn")
+    if args.detect_batch_size > 1 and not args.parallel:
+        ap.error("--detect-batch-size needs --parallel")
+
+    face_options = {
+        "model": args.model,
+        "upsample": args.upsample,
+        "num_jitters": args.num_jitters,
+        "downscale": args.downscale,
+    }
+    if args.face_cache_dir:
+        face_options["cache"] = FaceCache(
+            args.face_cache_dir,
+            max_disk_bytes=args.face_cache_disk_mb * 2 ** 20
+            if args.face_cache_disk_mb
+            else None,
+        )
+
+    store = None
+    if args.embedding_store:
+        store = EmbeddingStore(args.embedding_store, embedding_size=EMBEDDING_SIZE)
+
+    index = make_index(args.index, store=store)
     for url in args.urls:
-        add(index, url)
+        if not args.parallel:
+            add(index, url, store=store, face_options=face_options)
+        else:
+            from .pipeline import add_parallel
+
+            add_parallel(
+                index,
+                url,
+                store=store,
+                download_workers=args.download_workers,
+                detect_workers=args.detect_workers,
+                batch_size=args.batch_size,
+                face_options=face_options,
+                detect_batch_size=args.detect_batch_size,
+            )
+
+    # the ivfpq index only lives in memory while adding
+    if args.index == "ivfpq":
+        index.save(IVFPQ_INDEX_FILE)
+
+    if "cache" in face_options:
+        print("face cache:", face_options["cache"].stats())
@@ -1,9 +1,26 @@
-from .FaceData.models import FEmbed
-from .FaceData.utils import SessionCM as FaceDataSessionCM
+from collections import defaultdict
+
+import numpy as np
+
+from .FaceData.models import FEmbed, FEmbedBlob
+from .FaceData.utils import SessionCM as FaceDataSessionCM, blob_to_embedding
+from .LSH.config import EMBEDDING_SIZE
+from .LSH.utils import batch_mapper
 
 
 def default_sql_mapper(face_id):
     with FaceDataSessionCM() as session:
+        result = (
+            session.query(FEmbedBlob.embedding)
+            .filter(FEmbedBlob.vec_id == face_id)
+            .first()
+        )
+
+        if result:
+            return blob_to_embedding(result[0])
+
+        # embeddings that were not yet migrated to the fvec table
+        # are still stored as one fembed row per dimension
         results = (
             session.query(FEmbed.embed_val)
             .filter(FEmbed.vec_id == face_id)
@@ -13,3 +30,50 @@ def default_sql_mapper(face_id):
 
     face_embedding = [x[0] for x in results]
     return face_embedding
+
+
+@batch_mapper
+def default_sql_batch_mapper(face_ids, chunk_size=500):
+    """fetches the embeddings of all the face_ids with a few IN (...) queries
+    (chunk_size ids per query) in a single session
+
+    Returns: matrix where the i-th row is the embedding of face_ids[i]
+        (rows of unknown face_ids, and of incomplete embeddings, are filled with nan)
+    """
+    embeddings = {}
+
+    with FaceDataSessionCM() as session:
+        for start in range(0, len(face_ids), chunk_size):
+            chunk = face_ids[start : start + chunk_size]
+            results = (
+                session.query(FEmbedBlob.vec_id, FEmbedBlob.embedding)
+                .filter(FEmbedBlob.vec_id.in_(chunk))
+                .all()
+            )
+
+            for vec_id, blob in results:
+                embeddings[vec_id] = blob_to_embedding(blob)
+
+        # embeddings that were not yet migrated to the fvec table
+        missing = [face_id for face_id in face_ids if face_id not in embeddings]
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start : start + chunk_size]
+            results = (
+                session.query(FEmbed.vec_id, FEmbed.embed_val)
+                .filter(FEmbed.vec_id.in_(chunk))
+                .order_by(FEmbed.vec_id, FEmbed.embed_idx)
+                .all()
+            )
+
+            embed_vals = defaultdict(list)
+            for vec_id, embed_val in results:
+                embed_vals[vec_id].append(embed_val)
+            embeddings.update(embed_vals)
+
+    matrix = np.full((len(face_ids), EMBEDDING_SIZE), np.nan)
+    for row_num, face_id in enumerate(face_ids):
+        # faces whose fembed rows were only partly written are skipped like unknown ones
+        if len(embeddings.get(face_id, ())) == EMBEDDING_SIZE:
+            matrix[row_num] = embeddings[face_id]
+
+    return matrix
@@ -0,0 +1,187 @@
+"""
+Parallel version of core.main.add
+
+The images of a url go through three stages that run at the same time
+(the images are passed between the stages as bytes and are never written to disk):
+
+    download (thread pool of the scraper) -> detect (process pool, get_faces) -> write (single writer)
+
+Every stage keeps at most `window` images in flight, so the memory usage is bounded
+and a slow stage makes the previous stages wait (back pressure). The images come
+out of every stage in scraping order; the writer adds the faces to the FaceData
+database and to the index in batches of `batch_size` faces (one transaction per
+database per batch). Since faces are always written in order, an interrupted ingest
+resumes from the last written image like core.main.add.
+
+usage: python -m core.main --urls URL [URL ...] --parallel --download-workers 8 --detect-workers 4
+"""
+import os
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .main import get_faces, get_faces_batch
+from .utils import ordered_map, chunks
+from .scraper import scrape_url
+from .FaceData.add_face import add_many_data, update_scrape_state
+from .FaceData.utils import SessionCM as FaceDataSessionCM
+from .LSH.utils import SessionCM as FaceIndexSessionCM
+
+
+def detect(item, face_options=None):
+    """runs get_faces on a downloaded image (in a worker process)
+
+    Returns: (img_id, post_url, img_url, list of (face_num, face_loc, face_embedding),
+        counters of the face cache of the worker (see FaceCache.take_counters))
+    """
+    img_id, post_url, img_url, image = item
+    face_options = face_options or {}
+
+    faces = list(get_faces(image, **face_options))
+    return img_id, post_url, img_url, faces, take_counters(face_options.get("cache"))
+
+
+def detect_batch(items, face_options=None):
+    """detect for a list of downloaded images with batched cnn face detection
+    (see get_faces_batch)
+
+    Returns: (list of (img_id, post_url, img_url, faces), counters of the face cache)
+    """
+    face_options = dict(face_options or {})
+    face_options.pop("model", None)
+
+    faces = get_faces_batch([image for _, _, _, image in items], **face_options)
+    detected = [
+        (img_id, post_url, img_url, image_faces)
+        for (img_id, post_url, img_url, _), image_faces in zip(items, faces)
+    ]
+    return detected, take_counters(face_options.get("cache"))
+
+
+def take_counters(cache):
+    """counters of the face cache since the previous task of the worker process
+    (None without a cache)
+    """
+    return cache.take_counters() if cache is not None else None
+
+
+class Writer:
+    """adds the detected faces to the FaceData database, the index and
+    (optionally) the embedding store, batch_size faces at a time
+    """
+
+    def __init__(self, index, fd_session, fi_session, store=None, batch_size=100):
+        self.index = index
+        self.fd_session = fd_session
+        self.fi_session = fi_session
+        self.store = store
+        self.batch_size = batch_size
+
+        self.faces = []
+        self.num_faces = 0
+
+    def add(self, img_id, post_url, img_url, faces):
+        # committed with the face data of the batch
+        update_scrape_state(self.fd_session, img_id, len(faces))
+
+        for face_num, face_loc, face_embedding in faces:
+            self.faces.append(
+                {
+                    "vec_id": "{}_{}".format(img_id, face_num),
+                    "face_embedding": face_embedding,
+                    "face_loc": face_loc,
+                    "post_url": post_url,
+                    "img_url": img_url,
+                }
+            )
+
+        if len(self.faces) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # the faces are indexed first and the face data is committed last, together
+        # with the scrape state; after a crash in between, the images of the batch
+        # are scraped again (indexing the same faces again is a no-op) instead of
+        # their faces never being indexed
+        if self.faces:
+            face_ids = [face["vec_id"] for face in self.faces]
+            face_embeddings = [face["face_embedding"] for face in self.faces]
+
+            self.index.add_many(
+                session=self.fi_session, ids=face_ids, matrix=face_embeddings
+            )
+            if self.store is not None:
+                self.store.append(face_ids, face_embeddings)
+
+        add_many_data(self.fd_session, self.faces)
+        if not self.faces:
+            return
+
+        self.num_faces += len(self.faces)
+        self.faces = []
+        print("* added {} faces".format(self.num_faces))
+
+
+def add_parallel(
+    index,
+    url,
+    store=None,
+    download_workers=8,
+    detect_workers=None,
+    batch_size=100,
+    window=None,
+    face_options=None,
+    detect_batch_size=1,
+):
+    """core.main.add with concurrent downloads (download_workers threads), face
+    detection (detect_workers processes; defaults to the number of cpus) and a
+    single batched writer
+
+    window: maximum number of images (or batches of images) in flight in the
+        detection stage (defaults to twice the number of detect_workers; the
+        scraper keeps twice the number of download_workers in flight)
+    face_options: (optional) dict of get_faces options
+    detect_batch_size: when > 1, the faces of detect_batch_size images are detected
+        together with the batched cnn detector (see get_faces_batch)
+    """
+    if detect_workers is None:
+        detect_workers = os.cpu_count() or 1
+
+    detect_window = window or 2 * detect_workers
+
+    # the detection processes are spawned (not forked) since the download
+    # threads of the scraper are already running when they are started
+    with ProcessPoolExecutor(
+        detect_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as detect_pool, FaceDataSessionCM() as fd_session, FaceIndexSessionCM() as fi_session:
+        print("Scraping URL: ", url)
+
+        downloaded = scrape_url(url, download_workers=download_workers)
+        if detect_batch_size > 1:
+            batches = ordered_map(
+                detect_pool,
+                functools.partial(detect_batch, face_options=face_options),
+                chunks(downloaded, detect_batch_size),
+                detect_window,
+            )
+        else:
+            batches = (
+                ([(img_id, post_url, img_url, faces)], counters)
+                for img_id, post_url, img_url, faces, counters in ordered_map(
+                    detect_pool,
+                    functools.partial(detect, face_options=face_options),
+                    downloaded,
+                    detect_window,
+                )
+            )
+
+        # the stats of the worker processes are counted by the cache of this process
+        cache = (face_options or {}).get("cache")
+
+        writer = Writer(index, fd_session, fi_session, store, batch_size)
+        for detected, counters in batches:
+            if counters is not None:
+                cache.add_counters(counters)
+            for img_id, post_url, img_url, faces in detected:
+                writer.add(img_id, post_url, img_url, faces)
+        writer.flush()
@@ -0,0 +1,169 @@
+"""
+Cache of the (hydrated) matches of the searched face encodings
+
+The key of a face encoding is the hash of the encoding quantized to a grid of
+`step` (so that re-submitted photos, and crops that give nearly identical
+encodings, share an entry) combined with k and the query options.
+
+    - entries expire ttl seconds after they were cached
+    - at most max_items entries are kept (least recently used ones are evicted)
+    - an entry is dropped as soon as a face is added to one of the index buckets
+      that its query looked up (for a SQLDiskLSH index; see refresh), since the
+      new face could be one of its matches
+
+Every process keeps its own cache (Eg: every worker of the server).
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+# counters of the stats (see ResultCache.take_counters)
+COUNTERS = ("hits", "misses", "expirations", "evictions", "invalidations")
+
+
+def result_key(face_encoding, k=10, step=0.01, **query_options):
+    """cache key of the face encoding searched with the given k and query options"""
+    quantized = np.round(np.asarray(face_encoding, dtype=np.float64) / step)
+    options = ",".join(
+        "{}={}".format(name, value) for name, value in sorted(query_options.items())
+    )
+    return "{}-{}-{}".format(
+        hashlib.sha256(quantized.astype(np.int64).tobytes()).hexdigest(), k, options
+    )
+
+
+class ResultCache:
+    """
+    Args:
+        max_items: number of cached results
+        ttl: seconds after which a cached result expires
+        step: quantization step of the face encodings (see result_key)
+        poll_interval: minimum number of seconds between two checks for
+            updated buckets (see refresh)
+    """
+
+    def __init__(self, max_items=1024, ttl=300, step=0.01, poll_interval=5):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.step = step
+        self.poll_interval = poll_interval
+
+        # key -> (expiry time, matches, buckets)
+        self._items = OrderedDict()
+        # bucket -> keys of the results whose query looked up the bucket
+        self._keys_by_bucket = defaultdict(set)
+        self._lock = threading.Lock()
+
+        self._last_poll = 0
+        self._last_update = None
+        self._stats = dict.fromkeys(COUNTERS, 0)
+
+    def __len__(self):
+        return len(self._items)
+
+    def key(self, face_encoding, k=10, **query_options):
+        return result_key(face_encoding, k=k, step=self.step, **query_options)
+
+    def get(self, key):
+        """returns the cached matches of the key (None if they aren't cached)"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return None
+
+            expiry, matches, _ = item
+            if expiry <= time.time():
+                self._remove(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            self._items.move_to_end(key)
+            self._stats["hits"] += 1
+            return list(matches)
+
+    def put(self, key, matches, buckets=()):
+        """caches the matches; buckets are the index buckets looked up by the query"""
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+            self._items[key] = (time.time() + self.ttl, list(matches), tuple(buckets))
+            for bucket in buckets:
+                self._keys_by_bucket[bucket].add(key)
+
+            while len(self._items) > self.max_items:
+                self._remove(next(iter(self._items)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, buckets):
+        """drops the results whose query looked up any of the buckets"""
+        with self._lock:
+            keys = set()
+            for bucket in buckets:
+                keys.update(self._keys_by_bucket.get(bucket, ()))
+
+            for key in keys:
+                self._remove(key)
+            self._stats["invalidations"] += len(keys)
+
+    def refresh(self, get_updates):
+        """invalidates the results that depend on the buckets updated since the
+        last refresh (at most once every poll_interval seconds)
+
+        get_updates(since) returns (keys of the buckets updated after since,
+        time of the last update); Eg: SQLDiskLSH.get_bucket_updates with a session
+        """
+        with self._lock:
+            now = time.time()
+            if now - self._last_poll < self.poll_interval:
+                return
+            self._last_poll = now
+            since = self._last_update
+
+        buckets, last_update = get_updates(since)
+        self.invalidate(buckets)
+
+        with self._lock:
+            if last_update is not None:
+                self._last_update = max(last_update, self._last_update or last_update)
+            elif self._last_update is None:
+                # nothing was ever added; every update from now on is new
+                self._last_update = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["items"] = len(self._items)
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+        return stats
+
+    def take_counters(self):
+        """returns the counters (COUNTERS) and resets them; Eg: a worker process
+        passes the counters of its copy of the cache to the parent (see add_counters)
+        """
+        with self._lock:
+            counters = {name: self._stats[name] for name in COUNTERS}
+            self._stats.update(dict.fromkeys(COUNTERS, 0))
+            return counters
+
+    def add_counters(self, counters):
+        """adds the counters taken from a copy of the cache in another process"""
+        with self._lock:
+            for name in COUNTERS:
+                self._stats[name] += counters.get(name, 0)
+
+    def _remove(self, key):
+        _, _, buckets = self._items.pop(key)
+        for bucket in buckets:
+            keys = self._keys_by_bucket.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_bucket[bucket]
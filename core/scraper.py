@@ -1,12 +1,19 @@
 from urllib.parse import urlparse
-from sqlalchemy import distinct
 
 from .FaceData.utils import SessionCM as FaceDataSessionCM
-from .FaceData.models import FData
+from .FaceData.models import FData, ScrapeState
 from .utils import parse_face_id
 
 
-def scrape_url(url):
+def scrape_url(url, download=True, spool_dir=None, download_workers=8):
+    """yields (img_id, post_url, img_url, image) for every new image of the url
+    (in post order)
+
+    image is the downloaded image as bytes, or the path of a file in spool_dir
+    when a spool_dir is given (see IGS.scraper.scrape_instagram_account).
+    The images are downloaded by download_workers threads.
+    With download=False the images are not downloaded and image is None
+    """
     domain = find_domain(url)
     # img_id format : "<timestamp>_<domain>_<account_name>_<img_num>"
 
@@ -15,21 +22,14 @@ def scrape_url(url):
 
         account_name = extract_account_name_from_url(url)
 
+        # posts are numbered from 0; resume after the last scraped post
         with FaceDataSessionCM() as fd_session:
-            latest_face_id = (
-                fd_session.query(distinct(FData.vec_id))
-                .filter(FData.vec_id.like("%" + account_name + "%"))
-                .order_by(FData.vec_id.desc())
-                .first()
-            )
-
-        if latest_face_id:
-            latest_face_id = latest_face_id[0]
-            _, _, _, latest_post_num, _ = parse_face_id(latest_face_id)
-        else:
-            latest_post_num = 0
-
-        for data in scrape_instagram_url(url, latest_post_num):
+            state = get_scrape_state(fd_session, "instagram", account_name)
+            next_post_num = state.last_post_num + 1 if state else 0
+
+        for data in scrape_instagram_url(
+            url, next_post_num, download, spool_dir, download_workers
+        ):
             yield data
 
     elif "facebook" in domain:
@@ -44,3 +44,47 @@ def find_domain(url):
     domain = parsed.netloc
     return domain
 
+
+def get_scrape_state(session, domain, account_name):
+    """returns the ScrapeState of the account (None if it was never scraped)
+
+    accounts that were scraped before the scrape_state table existed get their
+    state from the face ids in fdata (once)
+    """
+    state = session.query(ScrapeState).get((domain, account_name))
+    if state is None:
+        state = bootstrap_scrape_state(session, domain, account_name)
+
+    return state
+
+
+def bootstrap_scrape_state(session, domain, account_name):
+    """creates the ScrapeState of an account from its face ids in fdata
+    (returns None if the account has no faces)
+    """
+    pattern = "%\\_{}\\_{}\\_%".format(domain, account_name.replace("_", "\\_"))
+    vec_ids = session.query(FData.vec_id).filter(
+        FData.vec_id.like(pattern, escape="\\")
+    )
+
+    last_post_num, last_timestamp, images, num_faces = -1, None, set(), 0
+    for (vec_id,) in vec_ids:
+        timestamp, face_domain, face_account_name, img_num, _ = parse_face_id(vec_id)
+        # the pattern also matches account names that contain "_<account_name>_"
+        if face_domain != domain or face_account_name != account_name:
+            continue
+
+        images.add(img_num)
+        num_faces += 1
+        if img_num > last_post_num:
+            last_post_num, last_timestamp = img_num, int(timestamp)
+
+    if not images:
+        return None
+
+    state = ScrapeState(
+        domain, account_name, last_post_num, last_timestamp, len(images), num_faces
+    )
+    session.add(state)
+    session.commit()
+    return state
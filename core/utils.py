@@ -1,3 +1,6 @@
+import collections
+
+
 def pil_compatible_bb(bb):
     if len(bb) != 4:
         raise ValueError(
@@ -8,9 +11,68 @@ def pil_compatible_bb(bb):
     return (left, top, right, bottom)
 
 
-def parse_face_id(id):
-    "<timestamp>_<domain>_<account_name>_<img_num>_<face_num>"
-    timestamp, domain, *account_name, img_num, face_num = id.split("_")
+def parse_img_id(img_id):
+    "<timestamp>_<domain>_<account_name>_<img_num>"
+    timestamp, domain, *account_name, img_num = img_id.split("_")
     account_name = "_".join(account_name)
 
-    return timestamp, domain, account_name, int(img_num), int(face_num)
+    return int(timestamp), domain, account_name, int(img_num)
+
+
+def parse_face_id(face_id):
+    "<timestamp>_<domain>_<account_name>_<img_num>_<face_num>"
+    img_id, face_num = face_id.rsplit("_", 1)
+
+    return parse_img_id(img_id) + (int(face_num),)
+
+
+def bulk_insert_ignore(session, table, rows, chunk_size=5000):
+    """Insert the given rows (list of dicts) into the table in chunks,
+    silently skipping the rows that already exist (duplicate primary key)
+
+    Doesn't commit; the caller decides the transaction boundaries
+    """
+    stmt = table.insert()
+
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        stmt = stmt.prefix_with("OR IGNORE")
+    elif dialect == "mysql":
+        stmt = stmt.prefix_with("IGNORE")
+
+    for start in range(0, len(rows), chunk_size):
+        session.execute(stmt, rows[start : start + chunk_size])
+
+
+def chunks(iterable, chunk_size):
+    """yields lists of (at most) chunk_size consecutive items of the iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def ordered_map(executor, fn, iterable, window):
+    """like executor.map, but the iterable is consumed lazily and at most
+    `window` items are submitted ahead of the results that were yielded
+
+    the results are yielded in the order of the iterable
+    """
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    finally:
+        for future in pending:
+            future.cancel()
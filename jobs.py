@@ -0,0 +1,270 @@
+"""
+Bounded queue of search jobs served by a dedicated pool of worker processes
+
+The upload handlers only enqueue the job and return its id, so slow face detections
+never hold the request threads (nor compete with them for the GIL). When the queue
+is full, submit raises QueueFull (the server answers 503 with a Retry-After header).
+
+The state of every job is kept in a json file in job_dir, so that a job can be polled
+from any server process, not only from the one that runs it (and so that the worker
+processes can report the progress of their jobs).
+"""
+import os
+import json
+import time
+import uuid
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobNotFound(Exception):
+    pass
+
+
+# job status
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# error of the jobs that failed with an unexpected exception
+INTERNAL_ERROR = "Internal error"
+
+
+class JobStore:
+    """json file per job in job_dir; jobs older than max_age seconds are deleted"""
+
+    def __init__(self, job_dir="./jobs", max_age=3600):
+        self.job_dir = job_dir
+        self.max_age = max_age
+        self._last_cleanup = 0
+
+        os.makedirs(job_dir, exist_ok=True)
+
+    def _path(self, job_id):
+        # job ids are generated by uuid4().hex; anything else is not a job
+        if not job_id.isalnum():
+            raise JobNotFound(job_id)
+        return os.path.join(self.job_dir, "{}.json".format(job_id))
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise JobNotFound(job_id)
+
+    def put(self, job):
+        # written to a temporary file first, so that readers never see a partial job
+        fd, tmp_path = tempfile.mkstemp(dir=self.job_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._path(job["id"]))
+
+    def delete(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def wait(self, job_id, timeout, interval=0.1):
+        """returns the job once it is done (or failed), or after timeout seconds"""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job["status"] in (DONE, FAILED) or time.time() >= deadline:
+                return job
+            time.sleep(interval)
+
+    def cleanup(self):
+        """deletes the jobs that are older than max_age (at most once a minute)"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+
+        for filename in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, filename)
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def run_job(fn, store, expected_errors, report, job, args):
+    """runs fn(*args) for the job (in a worker process) and saves its outcome
+
+    Returns: the value of report() (None without report)
+    """
+    start = time.time()
+    job["status"] = RUNNING
+    job["timings"]["queue"] = start - job["created"]
+    store.put(job)
+
+    try:
+        job["result"], timings = fn(*args)
+        job["timings"].update(timings)
+        job["status"] = DONE
+
+    except expected_errors as e:
+        job["error"] = str(e)
+        job["status"] = FAILED
+
+    except Exception as e:
+        print("* JOB FAILED: ", job["id"], repr(e))
+        job["error"] = INTERNAL_ERROR
+        job["status"] = FAILED
+
+    job["timings"]["total"] = time.time() - job["created"]
+    store.put(job)
+
+    return report() if report is not None else None
+
+
+class JobQueue:
+    """
+    Args:
+        fn: function run by the workers; fn(*args) returns (result, timings)
+            where timings is a dict of seconds per stage
+        store: JobStore in which the jobs are saved
+        workers: number of worker processes
+        max_pending: number of jobs that can wait for a worker
+        expected_errors: exceptions of fn that fail the job with their message
+            (other exceptions fail the job with INTERNAL_ERROR)
+        initializer: (optional) function run by every worker process when it starts
+            (Eg: to drop the database connections inherited from the parent)
+        report: (optional) function run by the worker process after every job,
+            whose (picklable) value is passed to collect in the parent process
+            (Eg: the cache stats of the job, see FaceCache.take_counters)
+        collect: (optional) function that receives the values of report
+
+    The worker processes are forked, so fn and the objects it uses (Eg: the index)
+    are inherited from the parent process instead of being loaded again (the pages
+    are shared copy-on-write). Forking copies the locks held by the other threads of
+    the parent, so the pool should be started (see start) before any other thread.
+    """
+
+    def __init__(
+        self,
+        fn,
+        store,
+        workers=2,
+        max_pending=16,
+        expected_errors=(),
+        initializer=None,
+        report=None,
+        collect=None,
+    ):
+        self.fn = fn
+        self.store = store
+        self.expected_errors = tuple(expected_errors)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.report = report
+        self.collect = collect
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+        self._pending = 0
+
+    def start(self):
+        """forks the worker processes of this process (a pool doesn't survive a fork,
+        Eg: of the uwsgi workers from the master); otherwise they are forked by the
+        first submit (or the first one after a worker died)
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._pool is not None:
+                return
+
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=self.initializer,
+            )
+            self._pending = 0
+            self._pid = os.getpid()
+
+            # the first task forks all the workers (before the thread that manages
+            # the pool is started)
+            self._pool.submit(int).result()
+
+    def __len__(self):
+        """number of jobs that are queued or running in this process"""
+        return self._pending if self._pid == os.getpid() else 0
+
+    def submit(self, *args):
+        """queues fn(*args) and returns the id of the job
+
+        raises QueueFull when max_pending jobs are already waiting
+        """
+        self.start()
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": QUEUED,
+            "created": time.time(),
+            "result": None,
+            "error": None,
+            "timings": {},
+        }
+
+        with self._lock:
+            if self._pending >= self.workers + self.max_pending:
+                raise QueueFull("Too many pending jobs")
+            self._pending += 1
+            pool = self._pool
+
+        # saved before it is queued, so that a worker never finds it missing
+        self.store.put(job)
+        try:
+            future = pool.submit(
+                run_job,
+                self.fn,
+                self.store,
+                self.expected_errors,
+                self.report,
+                job,
+                args,
+            )
+        except BrokenProcessPool:
+            # a worker died since the last submit; the pool is replaced on the next one
+            self._release(pool, broken=True)
+            self.store.delete(job["id"])
+            raise QueueFull("The workers are restarting")
+        future.add_done_callback(lambda future: self._finish(pool, job, future))
+
+        self.store.cleanup()
+        return job["id"]
+
+    def _release(self, pool, broken=False):
+        with self._lock:
+            if pool is not self._pool:
+                return
+            self._pending -= 1
+            if broken:
+                self._pool = None
+
+    def _finish(self, pool, job, future):
+        error = future.exception()
+        self._release(pool, broken=isinstance(error, BrokenProcessPool))
+        if error is None:
+            if self.collect is not None:
+                self.collect(future.result())
+            return
+
+        # the worker died while running the job (Eg: killed by the OOM killer)
+        print("* JOB FAILED: ", job["id"], repr(error))
+        job["status"] = FAILED
+        job["error"] = INTERNAL_ERROR
+        job["timings"]["total"] = time.time() - job["created"]
+        self.store.put(job)
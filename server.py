@@ -1,13 +1,36 @@
+import gc
 import os
+import shutil
+import time
+import hashlib
+import tempfile
+import threading
 import urllib.request
 import requests
+import numpy as np
 from flask import Flask, request, redirect, jsonify, g
 from flask_httpauth import HTTPBasicAuth
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 
 from core.LSH.lsh import SQLDiskLSH
-from utils import get_matches, _parse_firebase_error, NoFacesFound, MultipleFacesFound
+from core.LSH.config import EMBEDDING_SIZE, INDEX_TYPE, MAX_EUC_WINDOW
+from core.LSH.base import ENGINE as FACE_INDEX_ENGINE
+from core.FaceData.base import ENGINE as FACE_DATA_ENGINE
+from core.main import make_index, query
+from core.facecache import FaceCache
+from core.resultcache import ResultCache
+from core.FaceData.store import EmbeddingStore
+from core.mappers import default_sql_batch_mapper
+from utils import get_matches_many, _parse_firebase_error, NoFacesFound
+from jobs import (
+    JobQueue,
+    JobStore,
+    QueueFull,
+    JobNotFound,
+    DONE,
+    FAILED,
+    INTERNAL_ERROR,
+)
 
 from auth.token_system import generate_auth_token, verify_auth_token
 from auth.firebase_authentication import firebase_auth
@@ -17,54 +40,461 @@ CORS(app)
 
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
 app.config["UPLOAD_FOLDER"] = "./uploads"
+# larger uploads are rejected (413)
+app.config["MAX_CONTENT_LENGTH"] = int(
+    os.environ.get("MAX_UPLOAD_SIZE", 16 * 1024 * 1024)
+)
 ALLOWED_EXTENSIONS = set(["png", "jpg", "jpeg"])
 
+# uploads are passed to the job workers in memory; the ones larger than
+# UPLOAD_SPOOL_SIZE bytes are spooled to a temporary file (deleted once searched)
+UPLOAD_SPOOL_SIZE = int(os.environ.get("UPLOAD_SPOOL_SIZE", 4 * 1024 * 1024))
+
+# with RETAIN_UPLOADS=matches, the uploaded images that have at least one match
+# are saved in UPLOAD_FOLDER (named by the hash of their content); otherwise
+# no upload is written to disk
+RETAIN_UPLOADS = os.environ.get("RETAIN_UPLOADS", "none")
+
 http_basic_auth = HTTPBasicAuth()
 
-INDEX = SQLDiskLSH()
+# when EMBEDDING_STORE_DIR is set, the candidates are re-ranked using the memory-mapped
+# embedding store (shared by all the workers through the page cache)
+# and only the faces missing from the store are fetched from the FaceData database
+STORE = None
+MAPPER = default_sql_batch_mapper
+if os.environ.get("EMBEDDING_STORE_DIR"):
+    STORE = EmbeddingStore(
+        os.environ["EMBEDDING_STORE_DIR"],
+        embedding_size=EMBEDDING_SIZE,
+        fallback=default_sql_batch_mapper,
+    )
+    MAPPER = STORE
+
+# INDEX_TYPE selects the index: "lsh" (default) or "exact" (brute force)
+INDEX = make_index(os.environ.get("INDEX_TYPE", INDEX_TYPE), store=STORE)
+
+# when INDEX_SNAPSHOT_DIR is set, the LSH candidates are looked up in an in-memory
+# snapshot of the findex table (see core/LSH/memindex.py) instead of the database
+# (memory-mapped, so the workers share its pages)
+if isinstance(INDEX, SQLDiskLSH) and os.environ.get("INDEX_SNAPSHOT_DIR"):
+    INDEX.load_memory_index(
+        snapshot_dir=os.environ["INDEX_SNAPSHOT_DIR"], mmap_mode="r"
+    )
+
+
+# faces detected in the uploaded images, keyed by the hash of the image bytes
+# (FACE_CACHE_DIR adds a disk tier shared by all the workers, whose least recently
+# used images are deleted once it grows beyond FACE_CACHE_DISK_MB)
+FACE_CACHE = FaceCache(
+    os.environ.get("FACE_CACHE_DIR"),
+    max_items=int(os.environ.get("FACE_CACHE_SIZE", 1024)),
+    max_disk_bytes=int(os.environ["FACE_CACHE_DISK_MB"]) * 2 ** 20
+    if os.environ.get("FACE_CACHE_DISK_MB")
+    else None,
+)
+
+# matches of the searched faces, keyed by their quantized embeddings; a cached result
+# expires after RESULT_CACHE_TTL seconds, or as soon as a face is added to one of the
+# LSH buckets its search looked up (RESULT_CACHE_SIZE=0 disables the cache). The other
+# indexes don't record the buckets of the added faces, so they are never cached (nor
+# are the ones of an LSH index that isn't migrated to findex_v2, see can_cache_results)
+RESULT_CACHE = None
+if isinstance(INDEX, SQLDiskLSH) and int(os.environ.get("RESULT_CACHE_SIZE", 1024)) > 0:
+    RESULT_CACHE = ResultCache(
+        max_items=int(os.environ.get("RESULT_CACHE_SIZE", 1024)),
+        ttl=float(os.environ.get("RESULT_CACHE_TTL", 300)),
+    )
+
+
+# set once the index is warmed up (see warm_up); reported by /ready
+READY = threading.Event()
+WARMUP = {"seconds": None, "error": None}
+
+
+def prefault(array):
+    """reads every page of a (memory-mapped) array into the page cache"""
+    if array is not None and len(array):
+        np.add.reduce(np.asarray(array).reshape(len(array), -1), axis=0)
+
+
+def warm_up():
+    """touches the index artifacts (snapshot, embedding store) and runs a query,
+    so that the first request doesn't pay for the cold caches
+    """
+    start = time.perf_counter()
+    try:
+        if isinstance(INDEX, SQLDiskLSH) and INDEX.memory_index is not None:
+            for array in (
+                INDEX.memory_index.keys,
+                INDEX.memory_index.offsets,
+                INDEX.memory_index.postings,
+            ):
+                prefault(array)
+
+        if STORE is not None:
+            prefault(STORE.matrix)
+
+        query(INDEX, MAPPER, np.zeros(EMBEDDING_SIZE), k=1)
+
+    except Exception as e:
+        WARMUP["error"] = repr(e)
+        raise
+
+    else:
+        WARMUP["seconds"] = time.perf_counter() - start
+        READY.set()
+
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+
+def reset_db_connections():
+    # database connections must not be shared with the parent process
+    # (the master for the uwsgi workers, the uwsgi worker for the job workers)
+    FACE_INDEX_ENGINE.dispose()
+    FACE_DATA_ENGINE.dispose()
+
+
+if postfork is not None:
+    postfork(reset_db_connections)
+
+
+def get_extension(filename):
+    return filename.rsplit(".", 1)[1].lower()
 
 
 def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return "." in filename and get_extension(filename) in ALLOWED_EXTENSIONS
+
+
+def get_query_options():
+    """returns (query options of the request, error response or None)"""
+    # the euclidean window of the LSH index can be widened per request
+    # (a wider window finds more candidates but is slower)
+    query_options = {}
+    euc_window = request.form.get("euc_window", "")
+    if isinstance(INDEX, SQLDiskLSH) and euc_window:
+        # wider windows scan large parts of the index
+        if not euc_window.isdecimal() or int(euc_window) > MAX_EUC_WINDOW:
+            resp = jsonify(
+                {
+                    "message": "euc_window must be an integer between 0 and {}".format(
+                        MAX_EUC_WINDOW
+                    )
+                }
+            )
+            resp.status_code = 400
+            return None, resp
+        query_options["euc_window"] = int(euc_window)
 
+    return query_options, None
 
-@app.route("/", methods=["POST"])
-@http_basic_auth.login_required
-def upload_file():
+
+def get_uploaded_file():
+    """returns (uploaded file, error response or None)"""
     # check if the post request has the file part
     if "file" not in request.files:
         resp = jsonify({"message": "No file part in the request"})
         resp.status_code = 400
-        return resp
+        return None, resp
     file = request.files["file"]
     if file.filename == "":
         resp = jsonify({"message": "No file selected for uploading"})
         resp.status_code = 400
-        return resp
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(filepath)
-
-        try:
-            matches = get_matches(INDEX, filepath)
-            resp = jsonify({"matches": matches})
-            resp.status_code = 201
-
-        except (NoFacesFound, MultipleFacesFound) as err:
-            resp = jsonify({"message": str(err)})
-            resp.status_code = 400
-
-        finally:
-            return resp
-
-    else:
+        return None, resp
+    if not allowed_file(file.filename):
         resp = jsonify(
             {"message": "Allowed file types are {}".format(str(ALLOWED_EXTENSIONS))}
         )
         resp.status_code = 400
+        return None, resp
+
+    return file, None
+
+
+def spool_upload(file):
+    """returns the uploaded image as bytes, or the path of a temporary file holding
+    it when it is larger than UPLOAD_SPOOL_SIZE bytes (see search_upload)
+    """
+    image = file.stream.read(UPLOAD_SPOOL_SIZE + 1)
+    if len(image) <= UPLOAD_SPOOL_SIZE:
+        return image
+
+    fd, path = tempfile.mkstemp(suffix=".upload")
+    with os.fdopen(fd, "wb") as f:
+        f.write(image)
+        shutil.copyfileobj(file.stream, f)
+    return path
+
+
+def discard_upload(upload):
+    """deletes the temporary file of a spooled upload that won't be searched"""
+    if isinstance(upload, str):
+        os.remove(upload)
+
+
+def retain_upload(image, extension):
+    """saves the image (bytes or file-like object) in UPLOAD_FOLDER as <sha256>.<extension>"""
+    if hasattr(image, "read"):
+        image.seek(0)
+        image = image.read()
+
+    filename = "{}.{}".format(hashlib.sha256(image).hexdigest(), extension)
+    filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    if os.path.exists(filepath):
+        return
+
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=app.config["UPLOAD_FOLDER"], suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(image)
+    os.replace(tmp_path, filepath)
+
+
+def search(image, query_options, extension):
+    """searches every face of the image; returns (result, timings of every stage)
+
+    image is the uploaded image as bytes or a file-like object
+    """
+    timings = {}
+
+    # every face of the image is searched (with a single index query);
+    # "matches" is kept for the images with a single face
+    faces = get_matches_many(
+        INDEX,
+        image,
+        mapper=MAPPER,
+        face_cache=FACE_CACHE,
+        timings=timings,
+        result_cache=RESULT_CACHE,
+        **query_options
+    )
+    result = {"faces": faces}
+    if len(faces) == 1:
+        result["matches"] = faces[0]["matches"]
+
+    if RETAIN_UPLOADS == "matches" and any(face["matches"] for face in faces):
+        retain_upload(image, extension)
+
+    return result, timings
+
+
+def search_upload(upload, query_options, extension):
+    """search for an upload spooled by spool_upload (run by the job workers)"""
+    if not isinstance(upload, str):
+        return search(upload, query_options, extension)
+
+    try:
+        with open(upload, "rb") as image:
+            return search(image, query_options, extension)
+    finally:
+        os.remove(upload)
+
+
+def init_job_worker():
+    reset_db_connections()
+
+    # the stats of the caches are counted by the server process (see
+    # take_cache_counters); drop the ones inherited from it
+    take_cache_counters()
+
+
+def take_cache_counters():
+    """stats of the caches of the job worker since its previous job"""
+    return {
+        "face_cache": FACE_CACHE.take_counters(),
+        "result_cache": RESULT_CACHE.take_counters()
+        if RESULT_CACHE is not None
+        else None,
+    }
+
+
+def add_cache_counters(counters):
+    """adds the cache stats of a job to the caches of the server process (/stats)"""
+    FACE_CACHE.add_counters(counters["face_cache"])
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.add_counters(counters["result_cache"])
+
+
+# the searches are run by a pool of JOB_WORKERS processes per server process (forked
+# from it, so they share its index); at most JOB_QUEUE_SIZE searches wait for a
+# worker, further ones are rejected (503)
+JOBS = JobQueue(
+    search_upload,
+    JobStore(os.environ.get("JOB_DIR", "./jobs")),
+    workers=int(os.environ.get("JOB_WORKERS", 2)),
+    max_pending=int(os.environ.get("JOB_QUEUE_SIZE", 16)),
+    expected_errors=(NoFacesFound,),
+    initializer=init_job_worker,
+    report=take_cache_counters,
+    collect=add_cache_counters,
+)
+# seconds the clients are asked to wait before retrying when the queue is full
+JOB_RETRY_AFTER = 5
+# maximum number of seconds a GET /jobs/<job_id>?wait=... request waits for its job,
+# so that polling clients can't hold the request threads
+MAX_JOB_WAIT = 2
+# seconds after which POST / gives up waiting for its search (504)
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 30))
+
+
+def start_warm_up():
+    threading.Thread(target=warm_up, daemon=True).start()
+
+
+# with PRELOAD_INDEX=1 the index is warmed up while the app is loaded; under uwsgi
+# (without lazy-apps, see app.ini) that happens once in the master before the workers
+# are forked, so all the workers share the loaded pages copy-on-write. Otherwise
+# every process warms up in the background and /ready reports when it is done
+if os.environ.get("PRELOAD_INDEX") == "1":
+    warm_up()
+
+    # move the objects that exist now out of the reach of the garbage collector,
+    # so that collections in the workers don't write to (and copy) their pages
+    if hasattr(gc, "freeze"):
+        gc.collect()
+        gc.freeze()
+
+# the job workers are forked before any other thread is started (a forked worker
+# could inherit a lock held by another thread); under uwsgi, by every worker as
+# soon as it is forked from the master (a pool doesn't survive that fork)
+if postfork is not None:
+    postfork(JOBS.start)
+else:
+    JOBS.start()
+
+if os.environ.get("PRELOAD_INDEX") != "1":
+    if postfork is not None:
+        # threads don't survive the fork of the workers
+        postfork(start_warm_up)
+    else:
+        start_warm_up()
+
+
+def queue_full_response(err):
+    resp = jsonify({"message": str(err)})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(JOB_RETRY_AFTER)
+    return resp
+
+
+def job_accepted_response(job_id):
+    resp = jsonify({"job_id": job_id, "status_url": "/jobs/{}".format(job_id)})
+    resp.status_code = 202
+    resp.headers["Location"] = "/jobs/{}".format(job_id)
+    return resp
+
+
+@app.route("/", methods=["POST"])
+@http_basic_auth.login_required
+def upload_file():
+    file, resp = get_uploaded_file()
+    if resp is not None:
+        return resp
+
+    query_options, resp = get_query_options()
+    if resp is not None:
+        return resp
+
+    # searched by the job workers (see POST /jobs to poll for slow searches)
+    upload = spool_upload(file)
+    try:
+        job_id = JOBS.submit(upload, query_options, get_extension(file.filename))
+    except QueueFull as err:
+        discard_upload(upload)
+        return queue_full_response(err)
+
+    job = JOBS.store.wait(job_id, timeout=SEARCH_TIMEOUT)
+    if job["status"] == DONE:
+        result = job["result"]
+        result["timings"] = job["timings"]
+
+        resp = jsonify(result)
+        resp.status_code = 201
+        return resp
+
+    if job["status"] == FAILED:
+        resp = jsonify({"message": job["error"]})
+        resp.status_code = 500 if job["error"] == INTERNAL_ERROR else 400
+        return resp
+
+    resp = jsonify({"message": "The search timed out"})
+    resp.status_code = 504
+    return resp
+
+
+@app.route("/jobs", methods=["POST"])
+@http_basic_auth.login_required
+def submit_job():
+    """queues the search of the uploaded image; poll GET /jobs/<job_id> for the result"""
+    file, resp = get_uploaded_file()
+    if resp is not None:
+        return resp
+
+    query_options, resp = get_query_options()
+    if resp is not None:
+        return resp
+
+    upload = spool_upload(file)
+    try:
+        job_id = JOBS.submit(upload, query_options, get_extension(file.filename))
+
+    except QueueFull as err:
+        discard_upload(upload)
+        return queue_full_response(err)
+
+    return job_accepted_response(job_id)
+
+
+@app.route("/jobs/<job_id>")
+@http_basic_auth.login_required
+def get_job(job_id):
+    """returns the job; with ?wait=<seconds>, waits (up to MAX_JOB_WAIT seconds)
+    for the job to finish before answering
+    """
+    try:
+        wait = min(float(request.args.get("wait", 0)), MAX_JOB_WAIT)
+    except ValueError:
+        resp = jsonify({"message": "wait must be a number of seconds"})
+        resp.status_code = 400
+        return resp
+
+    try:
+        job = JOBS.store.wait(job_id, timeout=wait)
+    except JobNotFound:
+        resp = jsonify({"message": "Unknown job {}".format(job_id)})
+        resp.status_code = 404
         return resp
 
+    return jsonify(job)
+
+
+@app.route("/ready")
+def ready():
+    resp = jsonify(
+        {
+            "ready": READY.is_set(),
+            "warmup_seconds": WARMUP["seconds"],
+            "error": WARMUP["error"],
+        }
+    )
+    resp.status_code = 200 if READY.is_set() else 503
+    return resp
+
+
+@app.route("/stats")
+@http_basic_auth.login_required
+def get_stats():
+    return jsonify(
+        {
+            "face_cache": FACE_CACHE.stats(),
+            "result_cache": RESULT_CACHE.stats() if RESULT_CACHE is not None else None,
+        }
+    )
+
 
 @app.route("/auth/token")
 @http_basic_auth.login_required
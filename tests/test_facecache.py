@@ -0,0 +1,73 @@
+"""
+FaceCache: images without faces on the disk tier, the memory tier shared by the
+copies of a cache unpickled in one process, and the bounded disk tier
+"""
+import os
+import pickle
+
+from core.facecache import FaceCache, image_key
+from core.LSH.config import EMBEDDING_SIZE
+
+
+def make_faces(num_faces):
+    face_loc = (1, 2, 3, 4)
+    embedding = [0.5] * EMBEDDING_SIZE
+    return [(face_num, face_loc, embedding) for face_num in range(num_faces)]
+
+
+def test_image_without_faces(tmp_path):
+    key = image_key(b"no faces")
+    FaceCache(tmp_path).put(key, [])
+
+    cache = FaceCache(tmp_path)
+    assert cache.get(key) == []
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_round_trip(tmp_path):
+    key = image_key(b"two faces")
+    FaceCache(tmp_path).put(key, make_faces(2))
+
+    assert FaceCache(tmp_path).get(key) == make_faces(2)
+
+
+def test_unpickled_copies_share_memory(tmp_path):
+    cache = FaceCache(tmp_path)
+    data = pickle.dumps(cache)
+
+    first, second = pickle.loads(data), pickle.loads(data)
+    key = image_key(b"image")
+    first.put(key, make_faces(1))
+
+    # the file is gone, so the faces can only come from the shared memory tier
+    os.remove(first._path(key))
+    assert second.get(key) == make_faces(1)
+    counters = second.take_counters()
+    assert counters["memory_hits"] == 1
+    assert counters["disk_hits"] == counters["misses"] == 0
+    assert first.stats()["memory_hits"] == 0
+
+    # the cache that was pickled doesn't see the lookups of its copies
+    assert cache.stats()["memory_hits"] == 0
+    cache.add_counters(counters)
+    assert cache.stats()["hit_rate"] == 1
+
+
+def test_disk_tier_is_pruned(tmp_path):
+    cache = FaceCache(tmp_path, max_items=1)
+    cache.put(image_key(b"first"), make_faces(1))
+    file_size = os.path.getsize(cache._path(image_key(b"first")))
+
+    cache = FaceCache(tmp_path, max_items=1, max_disk_bytes=5 * file_size)
+    keys = [image_key(str(i).encode()) for i in range(20)]
+    for i, key in enumerate(keys):
+        cache.put(key, make_faces(1))
+        # distinct modification times, in insertion order
+        os.utime(cache._path(key), (i, i))
+
+    files = list(tmp_path.glob("*/*.npz"))
+    assert sum(path.stat().st_size for path in files) <= 5 * file_size
+    assert cache.stats()["disk_evictions"] > 0
+    # the most recently saved images are kept
+    assert cache.get(keys[-1]) == make_faces(1)
+    assert cache.get(keys[0]) is None
@@ -0,0 +1,117 @@
+"""
+download_items against a local stub http server: the images come back in the order
+of the items, and the 429 / 5xx responses are retried by the pooled session
+"""
+import time
+import random
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("igramscraper")
+requests = pytest.importorskip("requests")
+
+from core.IGS import scraper
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """/img<n> answers 429 to the first request when n % 3 == 0, then the image;
+    /down always answers 503
+    """
+
+    hits = collections.Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.hits[self.path] += 1
+            num_hits = self.hits[self.path]
+
+        # answer out of order
+        time.sleep(random.random() * 0.01)
+
+        if self.path == "/down":
+            self.send_error(503)
+            return
+
+        img_num = int(self.path[len("/img") :])
+        if img_num % 3 == 0 and num_hits == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = image_bytes(img_num)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def image_bytes(img_num):
+    # larger than scraper.CHUNK_SIZE, so the images are streamed in chunks
+    return "img{}".format(img_num).encode() * 20000
+
+
+@pytest.fixture
+def base_url():
+    StubHandler.hits.clear()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield "http://127.0.0.1:{}".format(server.server_address[1])
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_items_order_and_retries(base_url):
+    session = scraper.make_session(pool_size=4, backoff_factor=0)
+    items = [
+        ("id{}".format(i), "post{}".format(i), "{}/img{}".format(base_url, i))
+        for i in range(30)
+    ]
+
+    downloaded = list(
+        scraper.download_items(iter(items), download_workers=4, session=session)
+    )
+
+    assert [data[:3] for data in downloaded] == items
+    assert [data[3] for data in downloaded] == [image_bytes(i) for i in range(30)]
+
+    # every 429 was retried exactly once
+    for i in range(30):
+        assert StubHandler.hits["/img{}".format(i)] == (2 if i % 3 == 0 else 1)
+
+
+def test_download_items_spool_dir(base_url, tmp_path):
+    session = scraper.make_session(pool_size=2, backoff_factor=0)
+    items = [("id{}".format(i), "post", "{}/img{}".format(base_url, i)) for i in range(4)]
+
+    downloaded = list(
+        scraper.download_items(
+            iter(items), spool_dir=str(tmp_path), download_workers=2, session=session
+        )
+    )
+
+    for i, (_, _, _, path) in enumerate(downloaded):
+        with open(path, "rb") as f:
+            assert f.read() == image_bytes(i)
+
+
+def test_fetch_image_gives_up_after_retries(base_url):
+    session = scraper.make_session(pool_size=1, retries=2, backoff_factor=0)
+
+    with pytest.raises(requests.exceptions.RetryError):
+        scraper.fetch_image("{}/down".format(base_url), session)
+
+    # the first request and 2 retries
+    assert StubHandler.hits["/down"] == 3
@@ -0,0 +1,92 @@
+"""
+JobQueue: the jobs run in the worker processes and their outcome is saved in the
+store; a full queue raises QueueFull and a dead worker fails its job
+"""
+import os
+import time
+
+import pytest
+
+from jobs import JobQueue, JobStore, QueueFull, DONE, FAILED, INTERNAL_ERROR
+
+
+class NoFaces(Exception):
+    pass
+
+
+def search(x):
+    if x == "no faces":
+        raise NoFaces("No faces found")
+    if x == "bug":
+        raise ValueError("bug")
+    if x == "crash":
+        os._exit(1)
+    if x == "slow":
+        time.sleep(0.5)
+    return {"x": x, "pid": os.getpid()}, {"search": 0.1}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path))
+
+
+def test_jobs_run_in_worker_processes(store):
+    jobs = JobQueue(search, store, workers=2, expected_errors=(NoFaces,))
+
+    done = store.wait(jobs.submit(1), timeout=10)
+    assert done["status"] == DONE
+    assert done["result"]["x"] == 1
+    assert done["result"]["pid"] != os.getpid()
+    assert set(done["timings"]) == {"queue", "search", "total"}
+
+    no_faces = store.wait(jobs.submit("no faces"), timeout=10)
+    assert (no_faces["status"], no_faces["error"]) == (FAILED, "No faces found")
+
+    bug = store.wait(jobs.submit("bug"), timeout=10)
+    assert (bug["status"], bug["error"]) == (FAILED, INTERNAL_ERROR)
+
+
+def test_full_queue(store):
+    jobs = JobQueue(search, store, workers=1, max_pending=1)
+
+    job_ids = [jobs.submit("slow"), jobs.submit("slow")]
+    with pytest.raises(QueueFull):
+        jobs.submit("slow")
+
+    for job_id in job_ids:
+        assert store.wait(job_id, timeout=10)["status"] == DONE
+    # the finished jobs free their slots
+    assert store.wait(jobs.submit(1), timeout=10)["status"] == DONE
+
+
+def test_dead_worker_fails_its_job(store):
+    jobs = JobQueue(search, store, workers=1)
+
+    crash = store.wait(jobs.submit("crash"), timeout=10)
+    assert (crash["status"], crash["error"]) == (FAILED, INTERNAL_ERROR)
+
+    # the broken pool is replaced
+    assert store.wait(jobs.submit(1), timeout=10)["status"] == DONE
+
+
+REPORTS = []
+
+
+def report():
+    return os.getpid()
+
+
+def test_reports_are_collected(store):
+    jobs = JobQueue(search, store, workers=1, report=report, collect=REPORTS.append)
+    jobs.start()
+
+    for x in range(3):
+        store.wait(jobs.submit(x), timeout=10)
+    # the value is collected after the job is saved
+    deadline = time.time() + 10
+    while len(REPORTS) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert len(REPORTS) == 3
+    assert os.getpid() not in REPORTS
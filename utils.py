@@ -1,7 +1,8 @@
 import json
+import time
 
-from core.main import get_faces, query
-from core.mappers import default_sql_mapper
+from core.main import get_faces, query, query_many
+from core.mappers import default_sql_batch_mapper
 
 
 class NoFacesFound(Exception):
@@ -12,7 +13,14 @@ class MultipleFacesFound(Exception):
     pass
 
 
-def get_matches(index, filepath, k=10):
+def get_matches(
+    index,
+    filepath,
+    k=10,
+    mapper=default_sql_batch_mapper,
+    result_cache=None,
+    **query_options
+):
     faces = []
     for data in get_faces(filepath):
         faces.append(data)
@@ -28,11 +36,60 @@ def get_matches(index, filepath, k=10):
     else:
         face_data = faces[0]
         face_num, face_loc, face_embedding = face_data
-        matches = query(index, default_sql_mapper, face_embedding, k=k)
+        matches = query(
+            index, mapper, face_embedding, k=k, result_cache=result_cache, **query_options
+        )
 
     return matches
 
 
+def get_matches_many(
+    index,
+    filepath,
+    k=10,
+    mapper=default_sql_batch_mapper,
+    face_cache=None,
+    timings=None,
+    result_cache=None,
+    **query_options
+):
+    """get_matches for every face detected in the image (all the faces are searched at once)
+
+    filepath can also be the image as bytes (see core.main.get_faces)
+    face_cache: (optional) FaceCache consulted before detecting the faces
+    result_cache: (optional) ResultCache consulted before searching the faces
+    timings: (optional) dict in which the seconds spent in every stage are recorded
+        ("detect", "search" and "hydrate")
+
+    Returns: list of {"face_num", "loc", "matches"} (one per face)
+    """
+    start = time.perf_counter()
+    faces = list(get_faces(filepath, cache=face_cache))
+    if timings is not None:
+        timings["detect"] = time.perf_counter() - start
+
+    if len(faces) == 0:
+        raise NoFacesFound(
+            "No face is detected in the image. Please make sure that the image has atleast one face"
+        )
+
+    face_embeddings = [face_embedding for _, _, face_embedding in faces]
+    matches = query_many(
+        index,
+        mapper,
+        face_embeddings,
+        k=k,
+        timings=timings,
+        result_cache=result_cache,
+        **query_options
+    )
+
+    return [
+        {"face_num": face_num, "loc": face_loc, "matches": face_matches}
+        for (face_num, face_loc, _), face_matches in zip(faces, matches)
+    ]
+
+
 def _parse_firebase_error(e):
     error_json = e.args[1]
     error = json.loads(error_json)